@@ -0,0 +1,150 @@
+import functools
+import os
+import pathlib
+import pickle
+
+import numpy as np
+import pandas as pd
+
+import constants as const
+import store
+
+# columns of the summary.csv of a repository, named as in the merged summary.csv
+SUMMARY_COLUMNS = {
+    'date': 'date',
+    'files': 'file_count',
+    'skipped': 'skipped_file_count',
+    'timed_out': 'timed_out_file_count',
+    'too_large': 'too_large_file_count',
+    'line_count': 'line_count',
+    'lambdas': 'lambda_count',
+    'size': 'size',
+}
+SKIPPED_COLUMNS = ['skipped_file_count', 'timed_out_file_count', 'too_large_file_count']  # files not counted
+COUNT_COLUMNS = ['file_count', *SKIPPED_COLUMNS, 'line_count', 'lambda_count', 'size']
+RATES = ['lambda_rate', 'lambda_line_rate', 'skip_rate']
+FRAME_VERSION = 2  # of the frame cached in ANALYSIS_FILE, changed with its columns
+
+
+def get_summary_files():
+    """return {(language, owner, name): path} of the summary.csv of every repository"""
+    data_dir = pathlib.Path(const.DATA_DIR)
+    return {path.relative_to(data_dir).parts[:3]: path for path in sorted(data_dir.glob('*/*/*/!/summary.csv'))}
+
+
+def read_summaries(repositories):
+    """return the rows of the summary.csv of the repositories [(language, owner, name)] as strings
+
+    The frame has the columns of the merged summary.csv, the ones missing in older summaries are empty.
+    """
+    frames = []
+    for language, owner, name in repositories:
+        path = store.get_data_file(language, owner, name, filename='summary.csv')
+        frame = pd.read_csv(path, dtype=str, keep_default_na=False)
+        frame = frame.reindex(columns=list(SUMMARY_COLUMNS), fill_value='').rename(columns=SUMMARY_COLUMNS)
+        frame.insert(0, 'language', language)
+        frame.insert(1, 'nameWithOwner', f'{owner}/{name}')
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=['language', 'nameWithOwner', *SUMMARY_COLUMNS.values()])
+    return pd.concat(frames, ignore_index=True)
+
+
+def load(result_store=None):
+    """return the Results of all repositories, read again only when one of their summaries changed"""
+    summary_files = get_summary_files()
+    fingerprint = [(str(path), os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in summary_files.values()]
+    fingerprint.insert(0, FRAME_VERSION)
+    cache_file = pathlib.Path(f'{const.DATA_DIR}/{const.ANALYSIS_FILE}')
+    try:
+        with open(cache_file, 'rb') as f:
+            cached_fingerprint, frame = pickle.load(f)
+        if cached_fingerprint == fingerprint:
+            return Results(frame, result_store)
+    except FileNotFoundError:
+        pass
+
+    frame = get_rates(read_summaries(summary_files))
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_file, 'wb') as f:
+        pickle.dump((fingerprint, frame), f)
+    return Results(frame, result_store)
+
+
+def get_rates(summaries):
+    """return the summaries with numeric counts, the month of every row and its rates"""
+    frame = summaries.copy()
+    frame[COUNT_COLUMNS] = frame[COUNT_COLUMNS].apply(pd.to_numeric, errors='coerce')
+    frame['month'] = frame['date'].str.slice(stop=7)
+    frame['lambda_rate'] = frame['lambda_count'] / frame['file_count']
+    frame['lambda_line_rate'] = frame['lambda_count'] / frame['line_count'] * 100
+    # summaries written before timed out and too large files were told apart have them in skipped_file_count
+    frame['skip_rate'] = frame[SKIPPED_COLUMNS].sum(axis=1, min_count=1) / frame['file_count']
+    frame[RATES] = frame[RATES].replace([np.inf, -np.inf], np.nan)  # of commits without files
+    return frame
+
+
+class Results:
+    """the summaries of all repositories in a single frame, with the aggregates of the figures computed once
+
+    Rates are the lambdas per file (lambda_rate), per hundred lines (lambda_line_rate) and the share
+    of files not counted, skipped, timed out or too large (skip_rate) of a commit. Files of commits
+    are read from the store when queried.
+    """
+
+    def __init__(self, frame, result_store=None):
+        self.frame = frame
+        self.store = result_store or store.get_store()
+        self._pivots = {}
+        self._files = {}
+
+    @functools.cached_property
+    def monthly(self):
+        """return the mean rates of the repositories of every month and language, indexed by (month, language)"""
+        return self.frame.groupby(['month', 'language'])[RATES].mean()
+
+    def pivot(self, rate='lambda_line_rate', language=None):
+        """return the rate of every month by language, or by repository of the language, carried over missing months"""
+        if rate not in RATES:
+            raise Exception('bad rate')
+        key = (rate, language)
+        if key not in self._pivots:
+            if language is None:
+                self._pivots[key] = self.monthly[rate].unstack('language')
+            else:
+                frame = self.frame[self.frame['language'] == language]
+                self._pivots[key] = frame.pivot_table(index='month', columns='nameWithOwner', values=rate).ffill()
+        return self._pivots[key]
+
+    def get_files(self, date=None):
+        """return the files of the last commit up to the date of every repository, of the last commits by default"""
+        key = None if date is None else str(date)
+        if key not in self._files:
+            frames = []
+            for language, name_with_owner in self.frame[['language', 'nameWithOwner']].drop_duplicates().values:
+                owner, name = name_with_owner.split('/')
+                commits = pd.read_csv(store.get_data_file(language, owner, name), dtype=str)
+                if key is not None:
+                    commits = commits[commits['date'] <= key]
+                if commits.empty:
+                    continue
+                commit_date, commit = commits.iloc[-1][['date', 'id']]
+                files = self.store.get_files(language, owner, name, commit)
+                frame = pd.DataFrame(files, columns=['path', 'lambda_count', 'line_count', 'size'])
+                frame.insert(0, 'language', language)
+                frame.insert(1, 'nameWithOwner', name_with_owner)
+                frame.insert(2, 'date', commit_date)
+                frames.append(frame)
+            columns = ['language', 'nameWithOwner', 'date', 'path', 'lambda_count', 'line_count', 'size']
+            frame = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+            frame[columns[4:]] = frame[columns[4:]].astype(float).astype('Int64')  # the files of the store are strings
+            frame['lambda_line_rate'] = (frame['lambda_count'] / frame['line_count'] * 100).replace(np.inf, np.nan)
+            self._files[key] = frame
+        return self._files[key]
+
+    def top_files(self, n=10, language=None, by='lambda_count', date=None):
+        """return the n files with the most lambdas, or the highest value of another column, see get_files"""
+        files = self.get_files(date)
+        if language is not None:
+            files = files[files['language'] == language]
+        return files.nlargest(n, by)
@@ -0,0 +1,226 @@
+import datetime
+import json
+import os
+import pathlib
+import random
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+
+import constants as const
+import counters
+import local
+
+REPOSITORY_NAME = '_benchmark'  # in REPOSITORIES_DIR, removed when done
+
+# a unit of code with lambdas nested `depth` times, repeated up to the file size
+UNITS = {
+    const.CPP_LANG: lambda i, depth: (
+        f'int f{i}(int v) {{\n'
+        f'  auto l{i} = {_nest(depth, lambda d, inner: f"[&](int x{d}) {{ return {inner}; }}", "v")};\n'
+        f'  // {"filler " * (i % 7)}\n'
+        f'  return v * {i};\n'
+        f'}}\n'
+    ),
+    const.JAVA_LANG: lambda i, depth: (
+        f'    Object f{i}(int v) {{\n'
+        f'        Function<Integer, Object> l{i} = {_nest(depth, lambda d, inner: f"x{d} -> {inner}", "v")};\n'
+        f'        // {"filler " * (i % 7)}\n'
+        f'        return l{i}.apply(v * {i});\n'
+        f'    }}\n'
+    ),
+    const.JS_LANG: lambda i, depth: (
+        f'function f{i}(v) {{\n'
+        f'  const l{i} = {_nest(depth, lambda d, inner: f"(x{d}) => {inner}", "v")};\n'
+        f'  // {"filler " * (i % 7)}\n'
+        f'  return l{i}(v * {i});\n'
+        f'}}\n'
+    ),
+}
+HEADERS = {
+    const.CPP_LANG: '#include <functional>\n',
+    const.JAVA_LANG: 'import java.util.function.Function;\n\nclass Benchmark {\n',
+    const.JS_LANG: "'use strict';\n",
+}
+FOOTERS = {
+    const.CPP_LANG: '',
+    const.JAVA_LANG: '}\n',
+    const.JS_LANG: '',
+}
+
+
+def _nest(depth, make_lambda, body):
+    for d in range(depth):
+        body = make_lambda(d, body)
+    return body
+
+
+def make_file(language, size, depth, seed=0):
+    """return synthetic content of about size bytes, made of units with lambdas nested depth times"""
+    rng = random.Random(seed)
+    parts = [HEADERS[language]]
+    length = len(parts[0])
+    while length < size:
+        unit = UNITS[language](rng.randrange(10 ** 6), depth)
+        parts.append(unit)
+        length += len(unit)
+    parts.append(FOOTERS[language])
+    return ''.join(parts).encode()
+
+
+def get_fixture_files(language, path):
+    extensions = const.CONFIG[language][const.KEYS.EXTENSIONS]
+    paths = sorted(p for e in extensions for p in pathlib.Path(path).rglob(f'*.{e}') if not p.is_dir())
+    return [p.read_bytes() for p in paths]
+
+
+def time_counter(language, engine, contents):
+    """return the throughput and per-file latencies of counting the contents with the engine"""
+    latencies = []
+    skipped = 0
+    for content in contents:
+        start = time.perf_counter()
+        try:
+            counters.count_lambdas(language, content, engine)
+        except counters.SkipFile:
+            skipped += 1
+        latencies.append(time.perf_counter() - start)
+    return _get_stats(latencies, sum(map(len, contents)), skipped=skipped)
+
+
+def time_git_stages(language, commits, files, size):
+    """return the latencies of the git stages over a generated repository with commits changing files"""
+    make_repository(language, commits, files, size)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            data_file = f'{directory}/data.csv'
+            start = time.perf_counter()
+            commit_list = local.get_commits(language, REPOSITORY_NAME, data_file)
+            stats = {'get_commits': _get_stats([time.perf_counter() - start])}
+
+            saved = {}
+            latencies = {'checkout': [], 'get_files': [], 'get_blobs': []}
+            previous_commit = None
+            for _, commit in commit_list:
+                start = time.perf_counter()
+                local.checkout_commit(REPOSITORY_NAME, commit)
+                latencies['checkout'].append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                local.get_files(language, REPOSITORY_NAME, commit, previous_commit, saved.get, saved.__setitem__)
+                latencies['get_files'].append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                local.get_blobs(language, REPOSITORY_NAME, commit)
+                latencies['get_blobs'].append(time.perf_counter() - start)
+                previous_commit = commit
+        stats.update({stage: _get_stats(stage_latencies) for stage, stage_latencies in latencies.items()})
+        return stats
+    finally:
+        local.delete_repository(REPOSITORY_NAME)
+
+
+def make_repository(language, commits, files, size):
+    """create a repository with a commit every month from the language start date, changing a tenth of the files"""
+    path = f'{const.REPOSITORIES_DIR}/{REPOSITORY_NAME}'
+    local.delete_repository(REPOSITORY_NAME)
+    pathlib.Path(path).mkdir(parents=True)
+    _git(path, 'git init -q')
+    extension = const.CONFIG[language][const.KEYS.EXTENSIONS][0]
+    rng = random.Random(0)
+    date = const.CONFIG[language][const.KEYS.START_DATE]
+    for i in range(commits):
+        changed = range(files) if i == 0 else rng.sample(range(files), max(1, files // 10))
+        for j in changed:
+            file_path = pathlib.Path(f'{path}/src/{j % 16}/file{j}.{extension}')
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            file_path.write_bytes(make_file(language, size, 2, seed=i * files + j))
+        timestamp = f'{datetime.datetime.combine(date, datetime.time(12)).isoformat()}Z'
+        environment = {'GIT_AUTHOR_DATE': timestamp, 'GIT_COMMITTER_DATE': timestamp}
+        _git(path, 'git add -A')
+        _git(path, f'git -c user.name=benchmark -c user.email=benchmark commit -q -m {i}', environment)
+        date = (date.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+
+def _git(path, cmd, environment=None):
+    subprocess.run(
+        cmd.split(),
+        cwd=path,
+        env={**os.environ, **(environment or {})},
+        capture_output=True,
+        encoding='utf-8',
+        check=True,
+    )
+
+
+def _get_stats(latencies, size=None, **extra):
+    seconds = sum(latencies)
+    stats = {
+        'count': len(latencies),
+        'seconds': seconds,
+        'p50_ms': statistics.median(latencies) * 1000 if latencies else None,
+        'p99_ms': _percentile(latencies, 0.99) * 1000 if latencies else None,
+    }
+    if size is not None:
+        stats['files_per_second'] = len(latencies) / seconds if seconds else None
+        stats['mb_per_second'] = size / 2 ** 20 / seconds if seconds else None
+    stats.update(extra)
+    return stats
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def get_peak_rss():
+    """return the peak resident memory in MB of this process and of its largest finished child"""
+    return {
+        'self_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'children_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def compare(results, baseline):
+    """return {benchmark: {metric: current / baseline}} of the metrics found in both"""
+    ratios = {}
+    for name, stats in results.items():
+        if name not in baseline or not isinstance(stats, dict):
+            continue
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                nested = compare({key: value}, {key: baseline[name].get(key, {})})
+                ratios.update({f'{name}/{k}': v for k, v in nested.items()})
+            elif isinstance(value, (int, float)) and baseline[name].get(key):
+                ratios.setdefault(name, {})[key] = value / baseline[name][key]
+    return ratios
+
+
+def run(languages, files, size, depth, path, commits, git_files, baseline_file, save):
+    results = {}
+    for language in languages:
+        contents = [make_file(language, size, depth, seed=i) for i in range(files)]
+        fixtures = get_fixture_files(language, path) if path else []
+        for engine in const.ENGINES[language]:
+            try:
+                results[f'{language}:{engine}'] = time_counter(language, engine, contents)
+                if fixtures:
+                    results[f'{language}:{engine}:fixtures'] = time_counter(language, engine, fixtures)
+            except OSError as e:  # a counter needing a missing program
+                results[f'{language}:{engine}'] = {'error': str(e)}
+        if commits:
+            results[f'{language}:git'] = time_git_stages(language, commits, git_files, size)
+    results['peak_rss'] = get_peak_rss()
+
+    report = {'results': results}
+    if os.path.exists(baseline_file) and not save:
+        with open(baseline_file, 'r') as f:
+            report['compared_to_baseline'] = compare(results, json.load(f))
+    else:
+        pathlib.Path(baseline_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(baseline_file, 'w') as f:
+            json.dump(results, f, indent=2)
+        report['baseline_saved'] = baseline_file
+    return report
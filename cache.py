@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+
+import constants as const
+
+
+def get_blob_id(content):
+    """return the id git gives to a blob with the content"""
+    return hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
+
+
+class ResultCache:
+    """results of counting blobs, keyed by (language, counter version, blob id)"""
+
+    def __init__(self, path):
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS results (
+                    language TEXT, version INTEGER, blob TEXT, count INTEGER, skipped INTEGER, sample TEXT,
+                    line_count INTEGER,
+                    PRIMARY KEY (language, version, blob)
+                )
+            ''')
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(results)')]
+            if 'line_count' not in columns:  # created before line counts were recorded
+                self.connection.execute('ALTER TABLE results ADD COLUMN line_count INTEGER')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS stats (
+                    language TEXT PRIMARY KEY, hits INTEGER, misses INTEGER
+                )
+            ''')
+
+    def get(self, language, version, blob):
+        """return (count, skipped, sample, line count) or None, the line count is None for older results"""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT count, skipped, sample, line_count FROM results '
+                'WHERE language = ? AND version = ? AND blob = ?',
+                (language, version, blob),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], [tuple(s) for s in json.loads(row[2])], row[3]
+
+    def put(self, language, version, blob, count, skipped, sample, line_count):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (language, version, blob, count, skipped, json.dumps(sample), line_count),
+            )
+
+    def add_stats(self, language, hits, misses):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO stats VALUES (?, 0, 0)',
+                (language,),
+            )
+            self.connection.execute(
+                'UPDATE stats SET hits = hits + ?, misses = misses + ? WHERE language = ?',
+                (hits, misses, language),
+            )
+
+    def get_stats(self):
+        """return {language: (hits, misses)}"""
+        with self.lock:
+            rows = self.connection.execute('SELECT language, hits, misses FROM stats').fetchall()
+        return {language: (hits, misses) for language, hits, misses in rows}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache():
+    key = os.getpid()  # sqlite connections must not be shared with forked processes
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = ResultCache(f'{const.DATA_DIR}/{const.CACHE_FILE}')
+        return _caches[key]
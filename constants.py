@@ -6,11 +6,60 @@ JS_LANG = 'js'
 
 LANGUAGES = (CPP_LANG, JAVA_LANG, JS_LANG)
 
+WORKTREE_READ_MODE = 'worktree'
+OBJECTS_READ_MODE = 'objects'
+
+READ_MODES = (WORKTREE_READ_MODE, OBJECTS_READ_MODE)
+
+SKIPPED = 'skipped'
+TIMED_OUT = 'timed_out'
+TOO_LARGE = 'too_large'
+
+SKIP_REASONS = (SKIPPED, TIMED_OUT, TOO_LARGE)
+
+CPP_SCANNER_ENGINE = 'scanner'
+CPP_REGEX_ENGINE = 'regex'  # reference implementation
+JAVA_PARSER_ENGINE = 'javaparser'
+JS_ESPRIMA_ENGINE = 'esprima'
+JS_SCANNER_ENGINE = 'scanner'  # falls back to esprima for content it cannot tell apart
+
+ENGINES = {  # the first engine is the default one
+    CPP_LANG: (CPP_SCANNER_ENGINE, CPP_REGEX_ENGINE),
+    JAVA_LANG: (JAVA_PARSER_ENGINE,),
+    JS_LANG: (JS_ESPRIMA_ENGINE, JS_SCANNER_ENGINE),
+}
+
+CSV_STORAGE = 'csv'  # a directory of files for every commit
+SQLITE_STORAGE = 'sqlite'  # a single database, see STORE_FILE
+
+STORAGES = (CSV_STORAGE, SQLITE_STORAGE)
+
+FULL_CLONE = 'full'  # a clone of its own for every repository, deleted when it is done
+MIRROR_CLONE = 'mirror'  # working trees of a bare mirror kept in MIRRORS_DIR and updated by fetching
+BLOBLESS_CLONE = 'blobless'  # a mirror without blobs, they are fetched when checked out or read
+SHALLOW_CLONE = 'shallow'  # a mirror without the commits before the language start date
+
+CLONE_STRATEGIES = (FULL_CLONE, MIRROR_CLONE, BLOBLESS_CLONE, SHALLOW_CLONE)
+
+WEEKLY_SAMPLING = 'week'
+MONTHLY_SAMPLING = 'month'
+QUARTERLY_SAMPLING = 'quarter'
+
+SAMPLINGS = (WEEKLY_SAMPLING, MONTHLY_SAMPLING, QUARTERLY_SAMPLING)  # or a number n for every n-th commit
+
 REPOSITORY_COUNT = 10
 MIN_FILES_COUNT = 32
 
 DATA_DIR = 'data'
+CACHE_FILE = 'cache.sqlite'  # in DATA_DIR
+STORE_FILE = 'results.sqlite'  # in DATA_DIR
+GITHUB_CACHE_DIR = 'github'  # in DATA_DIR, responses of the GitHub API
+BENCHMARK_FILE = 'benchmark.json'  # in DATA_DIR, results other benchmarks are compared to
+ANALYSIS_FILE = 'analysis.pickle'  # in DATA_DIR, the summaries of all repositories, read again when one changes
+QUEUE_FILE = 'queue.sqlite'  # in DATA_DIR by default, leases of the workers of a distributed run
+JOURNAL_FILE = 'journal.jsonl'  # of every repository, results of the files counted for commits not saved yet
 REPOSITORIES_DIR = 'repositories'
+MIRRORS_DIR = 'mirrors'
 GITHUB_URL = 'https://github.com'
 
 MAX_COMMIT_DATE = datetime.date(2020, 6, 30)
@@ -21,9 +70,15 @@ class KEYS:
     TOKEN_FILE = 'token_file'
     QUERY_SIZE_LIMIT = 'query_size_limit'
     RETRIES = 'retries'
+    REST_URL = 'rest_url'
+    BATCH_SIZE = 'batch_size'
+    CONCURRENCY = 'concurrency'
+    SEARCH_RATE = 'search_rate'
     GITHUB_NAME = 'github_name'
     START_DATE = 'start_date'
     EXTENSIONS = 'extensions'
+    INCLUDE_PATHS = 'include_paths'  # fnmatch patterns of the paths from the repository root, none for all paths
+    EXCLUDE_PATHS = 'exclude_paths'  # fnmatch patterns of the paths left out, a * also matches slashes
     SKIP_REPOSITORIES = 'skip_repositories'
 
 
@@ -32,18 +87,24 @@ CONFIG = {
         KEYS.GITHUB_NAME: 'C++',
         KEYS.START_DATE: datetime.date(2011, 8, 12),
         KEYS.EXTENSIONS: ('cc', 'cpp', 'cxx', 'c++'),
+        KEYS.INCLUDE_PATHS: (),
+        KEYS.EXCLUDE_PATHS: (),
         KEYS.SKIP_REPOSITORIES: ('ariya/phantomjs',),
     },
     JAVA_LANG: {
         KEYS.GITHUB_NAME: 'Java',
         KEYS.START_DATE: datetime.date(2014, 3, 18),
         KEYS.EXTENSIONS: ('java',),
+        KEYS.INCLUDE_PATHS: (),
+        KEYS.EXCLUDE_PATHS: (),
         KEYS.SKIP_REPOSITORIES: ('elastic/elasticsearch',),
     },
     JS_LANG: {
         KEYS.GITHUB_NAME: 'JavaScript',
         KEYS.START_DATE: datetime.date(2015, 6, 1),
         KEYS.EXTENSIONS: ('js',),
+        KEYS.INCLUDE_PATHS: (),
+        KEYS.EXCLUDE_PATHS: (),  # e.g. '*.min.js' or '*node_modules/*', changing them changes the results
         KEYS.SKIP_REPOSITORIES: (),
     },
 }
@@ -51,9 +112,36 @@ CONFIG = {
 GITHUB_API_CONFIG = {
     KEYS.TOKEN_FILE: 'config/token.txt',
     KEYS.URL: 'https://api.github.com/graphql',
+    KEYS.REST_URL: 'https://api.github.com',
     KEYS.QUERY_SIZE_LIMIT: 100,
+    KEYS.BATCH_SIZE: 20,  # repositories in a query of their first commits
+    KEYS.CONCURRENCY: 8,  # requests at once
+    KEYS.SEARCH_RATE: 10,  # code searches a minute, the limit of the code search API
     KEYS.RETRIES: 3,
 }
 
-CPP_SAMPLE_PROBABILITY = 0.001
-CPP_SAMPLE_CONTEXT_MARGIN = 2
+MAX_FILE_SIZE = 4 * 2 ** 20  # bytes, larger files are not counted
+FILE_CPU_TIME_LIMIT = 60  # seconds of cpu time for counting a file
+WORKER_MEMORY_LIMIT = 4 * 2 ** 30  # bytes of memory of a counting process
+
+REPOSITORY_JOBS = 3  # repositories handled at once, each one keeps a clone on disk
+NETWORK_JOBS = 2  # concurrent clones
+GIT_JOBS = 4  # concurrent local git commands
+CPU_JOBS = None  # counting processes, defaults to the number of CPUs
+
+COUNTING_CHUNK_SIZE = 4  # files sent to a counting process at once
+
+OBJECTS_COMMIT_BATCH_SIZE = 12  # commits counted together in the objects read mode
+
+LEASE_COMMIT_COUNT = 24  # commits of a repository in a lease of a distributed run
+LEASE_DURATION = 600  # seconds a worker has to renew its lease, then other workers take it over
+LEASE_RENEW_INTERVAL = 120  # seconds between the renewals of a lease by the thread of its worker
+LEASE_POLL_INTERVAL = 30  # seconds a worker waits when all pending leases are taken
+
+JAVA_WORKER_COUNT = None  # defaults to the number of CPUs
+JAVA_WORKER_TIMEOUT = 60  # seconds per file
+
+SLOW_FILE_COUNT = 20  # files kept in the metrics of a repository, the slowest to count
+
+SAMPLE_BUDGET = 100  # lambdas sampled in a repository, the same ones for every run
+SAMPLE_CONTEXT_MARGIN = 2  # lines around a sampled lambda
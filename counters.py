@@ -1,138 +1,391 @@
-import random
+import atexit
+import bisect
+import contextlib
+import functools
+import os
 import re
-import subprocess
+import resource
+import signal
+import threading
 import warnings
 
 import esprima
 import esprima.error_handler
 
 import constants as const
-from constants import CPP_SAMPLE_PROBABILITY, CPP_SAMPLE_CONTEXT_MARGIN
+import instrumentation
+import sampling
+import workers
+from constants import SAMPLE_CONTEXT_MARGIN
+
+JAVA_COUNTER_CMD = 'java -jar java_counter/target/java_counter-1-shaded.jar'
+FLOW_STRIPPER_CMD = 'node flow_stripper/index.js'
+
+# bump when a counter starts returning different results, cached results of other versions are ignored
+VERSIONS = {
+    const.CPP_LANG: 3,
+    const.JAVA_LANG: 2,
+    const.JS_LANG: 2,
+}
+
+
+def count_lambdas(language, content, engine=None):
+    """count lambdas in the file content given as bytes, return (count, sample [(position, code)])"""
+    engine = engine or const.ENGINES[language][0]
+    if engine not in const.ENGINES[language]:
+        raise Exception('bad engine')
+    if len(content) > const.MAX_FILE_SIZE:
+        raise SkipFile(const.TOO_LARGE)
+    try:
+        with cpu_time_limit(const.FILE_CPU_TIME_LIMIT):
+            if language == const.CPP_LANG:
+                return count_lambdas_in_cpp(content, engine)
+            elif language == const.JAVA_LANG:
+                return count_lambdas_in_java(content)
+            elif language == const.JS_LANG:
+                return count_lambdas_in_js(content, engine)
+            else:
+                raise Exception('bad language')
+    except MemoryError:
+        raise SkipFile(const.TOO_LARGE)
 
 
-def count_lambdas(language, repository_name, path):
-    if language == const.CPP_LANG:
-        return count_lambdas_in_cpp(repository_name, path)
-    elif language == const.JAVA_LANG:
-        return count_lambdas_in_java(repository_name, path)
-    elif language == const.JS_LANG:
-        return count_lambdas_in_js(repository_name, path)
-    else:
-        raise Exception('bad language')
+@contextlib.contextmanager
+def cpu_time_limit(seconds):
+    """raise SkipFile(TIMED_OUT) once the process used the cpu time in the block, works only in the main thread"""
+    if not seconds or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def handler(signum, frame):
+        raise SkipFile(const.TIMED_OUT)
+
+    previous_handler = signal.signal(signal.SIGPROF, handler)
+    signal.setitimer(signal.ITIMER_PROF, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, previous_handler)
+
+
+def init_worker(profile_dir=None):
+    """prepare a counting process: limit its memory, warm up the parsers and profile it into profile_dir if given"""
+    if profile_dir:
+        instrumentation.profile_process(profile_dir)
+    limit_memory()
+    get_lambda_regex()
+    esprima.parseModule('() => 0')
+
+
+def limit_memory():
+    """limit the memory of the current process, counting a file exceeding it raises SkipFile(TOO_LARGE)"""
+    if not const.WORKER_MEMORY_LIMIT:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_DATA)
+    soft = const.WORKER_MEMORY_LIMIT if hard == resource.RLIM_INFINITY else min(const.WORKER_MEMORY_LIMIT, hard)
+    resource.setrlimit(resource.RLIMIT_DATA, (soft, hard))
+
+
+def count_lines(content):
+    """return the number of lines of the file content, as given by iterating over it in text mode"""
+    text = content.decode('utf-8', errors='ignore').replace('\r\n', '\n').replace('\r', '\n')
+    return text.count('\n') + (1 if text and not text.endswith('\n') else 0)
+
+
+def decode(content):
+    """decode the content the same way reading a file in text mode does"""
+    return content.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
 
 
 class SkipFile(Exception):
-    pass
+    def __init__(self, reason=const.SKIPPED):
+        super().__init__(reason)
+        self.reason = reason
+
 
+_java_workers = None
+_java_workers_lock = threading.Lock()
 
-def count_lambdas_in_java(repository_name, path):
-    full_path = f'{const.REPOSITORIES_DIR}/{repository_name}/{path}'
-    cmd = f'java -jar java_counter/target/java_counter-1-shaded.jar {full_path}'
+
+def get_java_workers():
+    global _java_workers
+    with _java_workers_lock:
+        if _java_workers is None:
+            _java_workers = workers.WorkerPool(JAVA_COUNTER_CMD.split(), const.JAVA_WORKER_COUNT or os.cpu_count())
+            atexit.register(_java_workers.close)
+        return _java_workers
+
+
+def count_lambdas_in_java(content):
     try:
-        result = subprocess.run(
-            cmd.split(),
-            capture_output=True,
-            encoding='utf-8',
-            check=True,
-        )
-    except subprocess.CalledProcessError:
+        result = get_java_workers().request(content, const.JAVA_WORKER_TIMEOUT)
+    except workers.WorkerTimeout:
+        raise SkipFile(const.TIMED_OUT)
+    except workers.WorkerError:
         raise SkipFile
-    return int(result.stdout), []
-
+    if result == 'skip':
+        raise SkipFile
+    count, *positions = result.split()
+    # the worker decodes the content with replacements and gives the lines and columns of the lambdas
+    text = content.decode('utf-8', errors='replace').replace('\r\n', '\n').replace('\r', '\n')
+    line_starts = [0] + [m.end() for m in re.finditer('\n', text)]
+    offsets = []
+    for position in positions:
+        line, column = map(int, position.split(':'))
+        offsets.append(line_starts[line - 1] + column - 1)
+    return int(count), get_sample(text, offsets)
+
+
+def count_lambdas_in_js(content, engine=const.JS_ESPRIMA_ENGINE):
+    if engine == const.JS_SCANNER_ENGINE:
+        try:
+            scanner = JsScanner(decode(content))
+            return scanner.count(), get_sample(scanner.content, scanner.positions)
+        except UnicodeDecodeError:
+            raise SkipFile
+        except UnclearJsContent:
+            pass  # parsed below
 
-def count_lambdas_in_js(repository_name, path):
-    full_path = f'{const.REPOSITORIES_DIR}/{repository_name}/{path}'
     warnings.simplefilter(action='ignore', category=FutureWarning)
     counter = JsCounter()
     try:
-        try:
-            with open(full_path, 'r') as f:
-                esprima.parseModule(f.read(), delegate=counter)
-        except esprima.error_handler.Error:
-            counter.reset()
-            cmd = f'flow-remove-types {full_path}'
-            result = subprocess.run(
-                cmd.split(),
-                capture_output=True,
-                encoding='utf-8',
-                check=True,
-            )
-            esprima.parseModule(result.stdout, delegate=counter)
+        # types are stripped only from files with a @flow pragma, the others would not change
+        if b'@flow' in content:
+            content = strip_flow_types(content)
+        text = decode(content)
+        esprima.parseModule(text, delegate=counter)
     except (esprima.error_handler.Error, UnicodeDecodeError, RecursionError):
         raise SkipFile
-    return counter.count, []
+    return counter.count, get_sample(text, counter.positions)
+
+
+_flow_strippers = {}
+
+
+def strip_flow_types(content):
+    key = os.getpid()  # workers of a parent process must not be shared with forked ones
+    if key not in _flow_strippers:
+        _flow_strippers[key] = workers.WorkerPool(FLOW_STRIPPER_CMD.split(), 1)
+        atexit.register(_flow_strippers[key].close)
+    try:
+        result = _flow_strippers[key].request_content(content, const.FILE_CPU_TIME_LIMIT)
+    except workers.WorkerTimeout:
+        raise SkipFile(const.TIMED_OUT)
+    except workers.WorkerError:
+        raise SkipFile
+    if result is None:
+        raise SkipFile
+    return result
 
 
 class JsCounter:
     def __init__(self):
         self.count = 0
+        self.positions = []
 
     def __call__(self, node, meta):
         if node.type == 'ArrowFunctionExpression':
             self.count += 1
+            self.positions.append(meta.start.offset)
 
     def reset(self):
         self.count = 0
+        self.positions = []
 
 
-def count_lambdas_in_cpp(repository_name, path):
-    full_path = f'{const.REPOSITORIES_DIR}/{repository_name}/{path}'
-    try:
-        with open(full_path, 'r') as f:
-            content = f.read()
-    except UnicodeDecodeError:
-        raise SkipFile
+class UnclearJsContent(Exception):
+    pass
+
+
+class JsScanner:
+    """
+    count arrow functions as the `=>` punctuators of the token stream, without building a syntax tree
+
+    Whether a slash starts a regular expression is decided by the previous token, parentheses and
+    braces remember whether an expression may follow them. Content the tokens alone cannot tell
+    apart (jsx, flow annotations, unbalanced brackets, unterminated literals, characters outside
+    of the language) raises UnclearJsContent, it is left to a parser.
+    """
+    COMMON = (
+        r'(?P<space>[\s\ufeff]+)'
+        r'|(?P<comment>//[^\n\r\u2028\u2029]*|/\*[\s\S]*?\*/)'
+        r'|(?P<unterminated>/\*)'
+        r"""|(?P<string>'(?:[^'\\\n\r]|\\(?:\r\n|[\s\S]))*'|"(?:[^"\\\n\r]|\\(?:\r\n|[\s\S]))*")"""
+        r'|(?P<template>`(?:[^`\\$]|\\[\s\S]|\$(?!\{))*(?:`|\$\{))'
+        r'|(?P<name>(?:[^\W\d]|\$)[\w$\u200c\u200d]*)'
+        r'|(?P<number>\.?\d(?:[\w.]|(?<=[eE])[+-])*)'
+    )
+    PUNCTUATOR = (
+        r'|(?P<punctuator>=>|\.\.\.|\?\.(?!\d)|\+\+|--|>>>=?|<<=?|>>=?|\*\*=?|[=!]==?|&&=?|\|\|=?|\?\?=?'
+        r'|[-+*%&|^<>=!]=?|[~?:;,.()\[\]{}])'
+        r'|(?P<other>[\s\S])'
+    )
+    TOKEN_BEFORE_EXPRESSION = re.compile(
+        COMMON + r'|(?P<regex>/(?:[^/\\\[\n\r]|\\.|\[(?:[^\]\\\n\r]|\\.)*\])+/[\w$]*)' + PUNCTUATOR
+    )
+    TOKEN_AFTER_EXPRESSION = re.compile(COMMON + r'|(?P<division>/=?)' + PUNCTUATOR)
+    TEMPLATE_CONTINUATION = re.compile(r'(?:[^`\\$]|\\[\s\S]|\$(?!\{))*(?:`|\$\{)')
+    # words after which an expression starts, so that a slash starts a regular expression
+    OPERATOR_WORDS = {
+        'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void', 'throw', 'case', 'do', 'else',
+        'yield', 'await', 'extends',
+    }
+    CONDITION_WORDS = {'if', 'while', 'for', 'with'}  # a slash after their parentheses starts a regular expression
+    BLOCK_PRECEDING = {None, '=>', ';', '{', '}', 'else', 'do', 'try', 'finally'}
+
+    def __init__(self, content):
+        self.content = content
+        self.positions = []  # of the arrows, once counted
+
+    def count(self):
+        content = self.content
+        if '@flow' in content:
+            raise UnclearJsContent
+        count = 0
+        stack = []  # open brackets with whether an expression may follow their closing one
+        expression = True  # whether an expression may start at the position
+        previous = None  # previous token, other than spaces and comments
+        position = 0
+        while position < len(content):
+            tokens = self.TOKEN_BEFORE_EXPRESSION if expression else self.TOKEN_AFTER_EXPRESSION
+            token = tokens.match(content, position)
+            kind = token.lastgroup
+            position = token.end()
+            if kind in ('space', 'comment'):
+                continue
+            text = token.group()
+
+            if kind in ('string', 'number', 'regex'):
+                expression = False
+            elif kind == 'template':
+                expression = text.endswith('${')
+                if expression:
+                    stack.append(('${', False))
+            elif kind == 'name':
+                expression = text in self.OPERATOR_WORDS and previous not in ('.', '?.')
+            elif kind == 'division':
+                expression = True
+            elif kind == 'punctuator':
+                if text == '=>':
+                    count += 1
+                    self.positions.append(token.start())
+                    expression = True
+                elif text in '([':
+                    stack.append((text, text == '(' and previous in self.CONDITION_WORDS))
+                    expression = True
+                elif text == '{':
+                    stack.append((text, not expression or previous in self.BLOCK_PRECEDING))
+                    expression = True
+                elif text in ')]}':
+                    if not stack:
+                        raise UnclearJsContent
+                    bracket, expression = stack.pop()
+                    if bracket == '${' and text == '}':
+                        continuation = self.TEMPLATE_CONTINUATION.match(content, position)
+                        if not continuation:
+                            raise UnclearJsContent
+                        position = continuation.end()
+                        expression = continuation.group().endswith('${')
+                        if expression:
+                            stack.append(('${', False))
+                    elif bracket + text not in ('()', '[]', '{}'):
+                        raise UnclearJsContent
+                elif text in ('++', '--'):
+                    expression = False
+                elif text == '<' and expression:  # jsx or type parameters
+                    raise UnclearJsContent
+                else:
+                    expression = True
+            else:
+                raise UnclearJsContent
+            previous = text
+
+        if stack:
+            raise UnclearJsContent
+        return count
+
+
+def count_lambdas_in_cpp(content, engine=const.CPP_SCANNER_ENGINE):
+    """count on the bytes of the content, positions are byte offsets once newlines are normalized
+
+    Only the code around the sampled lambdas is decoded, so content in any encoding is counted.
+    """
+    if b'\r' in content:  # the newlines of text mode, the other files are not copied
+        content = content.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
     original_content = content
-    content = preprocess(content)
+    if engine == const.CPP_SCANNER_ENGINE:
+        cuts = CppScanner(content)
+    else:
+        cuts = BracketsIterator(preprocess(content))
 
-    lambda_re = LambdaRegex().compile()
-    count = 0
-    sample = []
+    lambda_re = get_lambda_regex()
+    positions = []
     try:
-        for bc in BracketsIterator(content):
+        for bc in cuts:
             for match in lambda_re.finditer(bc):
-                count += 1
-                if random.random() < CPP_SAMPLE_PROBABILITY:
-                    position = int(match.group(1))
-                    sample.append((position, get_original_code(position, original_content)))
+                positions.append(int(match.group(1)))
     except InvalidFinalContent:
         raise SkipFile
-    return count, sample
+    return len(positions), get_sample(original_content, positions)
+
+
+def get_sample(content, positions):
+    """return the sample [(position, code)] of the lambdas at the positions of the content"""
+    reservoir = sampling.Reservoir()
+    for position in positions:
+        reservoir.add((position, get_original_code(position, content)))
+    return reservoir.items()
 
 
 def get_original_code(position, original_content):
+    """return the lines around the position of the text or bytes content, bytes are decoded with replacements"""
+    newline = b'\n' if isinstance(original_content, bytes) else '\n'
     newline_count = 0
     pos = position
-    while newline_count != CPP_SAMPLE_CONTEXT_MARGIN + 1 and pos != -1:
-        pos = original_content.rfind('\n', 0, pos - 1)
+    while newline_count != SAMPLE_CONTEXT_MARGIN + 1 and pos != -1:
+        pos = original_content.rfind(newline, 0, pos - 1)
         newline_count += 1
     start_pos = pos + 1
 
     newline_count = 0
     pos = position
-    while newline_count != CPP_SAMPLE_CONTEXT_MARGIN + 1 and pos != -1:
-        pos = original_content.find('\n', pos + 1)
+    while newline_count != SAMPLE_CONTEXT_MARGIN + 1 and pos != -1:
+        pos = original_content.find(newline, pos + 1)
         newline_count += 1
     end_pos = pos
 
-    return original_content[start_pos:end_pos]
+    code = original_content[start_pos:end_pos]
+    return code.decode('utf-8', errors='replace') if isinstance(code, bytes) else code
+
+
+# a character of UTF-8 content, or any other single byte, but a line break
+CODE_POINT = r'(?:[\xc0-\xff][\x80-\xbf]{0,3}|[^\n])'
+PREPROCESS_CANDIDATE = re.compile(rb'\[(?!\')')
+PREPROCESS_CHAR = re.compile(rf'\'\\?{CODE_POINT}\''.encode())
+PREPROCESS_STRING = re.compile(rb'"(?:[^\\\"\n]|(?:\\.))*"')
+PREPROCESS_DIRECTIVE = re.compile(rb'(?:(?<=^)|(?<=\n))#.*')
+PREPROCESS_SHORT_COMMENT = re.compile(rb'//.*')
+PREPROCESS_LONG_COMMENT = re.compile(rb'/\*.*?\*/')
+PREPROCESS_SPACES = re.compile(rb'\s{2,}|[^\S ]')  # a single space is left as is, to keep few pieces
+OPERATOR_SUBSCRIPT = re.compile(rb'operator\s*\[\d+]')
 
 
 def preprocess(content):
-    content = re.sub(r'\[(?!\')', lambda match: f'[<{match.start()}>', content)  # annotate lambda candidates positions
+    content = PREPROCESS_CANDIDATE.sub(lambda match: b'[<%d>' % match.start(), content)  # annotate lambda candidates positions
 
-    content = content.replace('\\\n', '')  # join broken lines
+    content = content.replace(b'\\\n', b'')  # join broken lines
 
-    content = re.sub(r'\'\\?.\'', '\'\'', content)  # clear chars
-    content = re.sub(r'"(?:[^\\\"\n]|(?:\\.))*"', '""', content)  # clear string contents
+    content = PREPROCESS_CHAR.sub(b"''", content)  # clear chars
+    content = PREPROCESS_STRING.sub(b'""', content)  # clear string contents
 
-    content = re.sub(r'(?:(?<=^)|(?<=\n))#.*', '', content)  # remove directives
-    content = re.sub(r'//.*', '', content)  # remove short comments
+    content = PREPROCESS_DIRECTIVE.sub(b'', content)  # remove directives
+    content = PREPROCESS_SHORT_COMMENT.sub(b'', content)  # remove short comments
 
-    content = content.replace('\n', ' ')  # join lines
-    content = re.sub(r'/\*.*?\*/', '', content)  # remove long comments
+    content = content.replace(b'\n', b' ')  # join lines
+    content = PREPROCESS_LONG_COMMENT.sub(b'', content)  # remove long comments
 
-    content = re.sub(r'\s+', ' ', content)  # simplify whitespaces
+    content = PREPROCESS_SPACES.sub(b' ', content)  # simplify whitespaces
     return content
 
 
@@ -143,12 +396,20 @@ class InvalidFinalContent(Exception):
 class BracketsIterator:
     BRACKETS = [('{', '}'), (r'\[', r'\]'), (r'\(', r'\)')]
     ALL_BS = ''.join(b for bs in BRACKETS for b in bs)
+    # compiled once, in the order of BRACKETS, with replacements needing no template expansion
+    LEAF_CLEARERS = (
+        (re.compile(rf'{{[^{ALL_BS}]+}}'.encode()), b'{}'),
+        (re.compile(rf'\[<(\d+)>[^{ALL_BS}]*]'.encode()), lambda match: b'[%b]' % match.group(1)),
+        (re.compile(rf'\([^{ALL_BS}]+\)'.encode()), b'()'),
+    )
+    NOT_ALL_BS = fr'[^{ALL_BS}]'
+    LEAF_MID = fr'((?:{NOT_ALL_BS}*(?:(?:{{}})|(?:\(\))|(?:\[\d+])))+{NOT_ALL_BS}*)'
+    LEAF_CUTTER = re.compile(fr'(?:({{){LEAF_MID}(}}))|(?:(\(){LEAF_MID}(\)))|(?:(\[)<(\d+)>{LEAF_MID}(]))'.encode())
 
     def __init__(self, content):
         self.content = content
         self.previous_content = None
-        self.leaf_cutter = self.compile_leaf_cutter()
-        self.cuts = None
+        self.cuts = []  # of the last cut, cleared for the next one
 
     def __iter__(self):
         self.add_root()
@@ -157,39 +418,129 @@ class BracketsIterator:
             self.previous_content = self.content
             self.cut_leaves()
             yield from self.cuts
-        if self.content != f'{self.BRACKETS[0][0]}{self.BRACKETS[0][1]}':
+        if self.content != b'{}':
             raise InvalidFinalContent(self.content)
 
     def add_root(self):
-        self.content = rf'{self.BRACKETS[0][0]}{self.content}{self.BRACKETS[0][1]}'
+        self.content = b'{%b}' % self.content
 
     def clear_leaves(self):
-        for left, right in self.BRACKETS:
-            if left != r'\[':
-                self.content = re.sub(rf'({left})[^{self.ALL_BS}]+({right})', r'\g<1>\g<2>', self.content)
-            else:
-                self.content = re.sub(rf'\[<(\d+)>[^{self.ALL_BS}]*]', r'[\g<1>]', self.content)
-
-    def compile_leaf_cutter(self):
-        notallbs = fr'[^{self.ALL_BS}]'
-        inner = r'(?:(?:{})|(?:\(\))|(?:\[\d+]))'
-        mid = fr'((?:{notallbs}*{inner})+{notallbs}*)'
-        pattern = fr'(?:({{){mid}(}}))|(?:(\(){mid}(\)))|(?:(\[)<(\d+)>{mid}(]))'
-        return re.compile(pattern)
+        for clearer, replacement in self.LEAF_CLEARERS:
+            self.content = clearer.sub(replacement, self.content)
 
     def cut_leaves(self):
-        self.cuts = []
-        self.content = self.leaf_cutter.sub(self.sub_handler, self.content)
+        self.cuts.clear()
+        self.content = self.LEAF_CUTTER.sub(self.sub_handler, self.content)
 
     def sub_handler(self, match_obj):
-        content = match_obj.group(2) or match_obj.group(5) or match_obj.group(9)
-        content = re.sub(r'operator\s*\[\d+]', 'operator', content)  # disarm operator[]
+        last = match_obj.lastindex  # the closing bracket of the matched alternative
+        if last == 3:
+            content, replacement = match_obj.group(2), b'{}'
+        elif last == 6:
+            content, replacement = match_obj.group(5), b'()'
+        else:
+            content, replacement = match_obj.group(9), b'[%b]' % match_obj.group(8)
+        if b'operator' in content:
+            content = OPERATOR_SUBSCRIPT.sub(b'operator', content)  # disarm operator[]
         self.cuts.append(content)
+        return replacement
+
+
+class CppScanner:
+    """
+    yield the same cuts as BracketsIterator(preprocess(content)) of the bytes content in a single left-to-right pass
+
+    Tokens mirror the preprocess passes, including their precedence: chars and strings are cleared
+    and line comments and directives removed even inside of long comments. Every bracket is kept
+    on a stack with its content, in which the already closed inner brackets are collapsed.
+    """
+    # sub-patterns of a long comment must not backtrack into matching a shorter token
+    CHAR = rf"'(?:\\{CODE_POINT}|(?!\\{CODE_POINT}'){CODE_POINT})'"
+    NOT_CHAR = rf"'(?!\\?{CODE_POINT}')"
+    STRING_BODY = rf"(?:{CHAR}|{NOT_CHAR}|[^'\\\"\n]|\\.)*"
+    STRING = rf'"{STRING_BODY}"'
+    LINE = r'[^\n]*(?![^\n])'
+    LONG_COMMENT = (
+        r'/\*(?:'
+        rf'{CHAR}|{STRING}|//{LINE}|(?<=\n)#{LINE}|'
+        rf'{NOT_CHAR}|"(?!{STRING_BODY}")|/(?!/)|(?<!\n)#|\*(?!/(?!/))|[^\'"/#*]'
+        r')*?\*/(?!/)'
+    )
+    TOKEN = re.compile((
+        rf'(?P<char>{CHAR})'
+        rf'|(?P<string>{STRING})'
+        rf'|(?P<comment>//[^\n]*|{LONG_COMMENT})'
+        r'|(?P<directive>(?:^|(?<=\n))#[^\n]*)'
+        r'|(?P<open>[\[({])'
+        r'|(?P<close>[\])}])'
+        r'|(?P<text>[^\[\](){}\'"/#]+|.)'
+    ).encode())
+    CLEARED = {'char': b"''", 'string': b'""'}
+    PAIRS = {b'{': b'}', b'(': b')', b'[': b']'}
 
-        left = match_obj.group(1) or match_obj.group(4) or match_obj.group(7)
-        right = match_obj.group(3) or match_obj.group(6) or match_obj.group(10)
-        position = match_obj.group(8) or ''
-        return f'{left}{position}{right}'
+    def __init__(self, content):
+        self.original_content = content
+        self.content = content
+        self.joins = []  # positions in the joined content preceded by a removed line break
+        pos = content.find(b'\\\n')
+        if pos != -1:
+            self.content = content.replace(b'\\\n', b'')  # join broken lines
+        while pos != -1:
+            self.joins.append(pos - 2 * len(self.joins))
+            pos = content.find(b'\\\n', pos + 2)
+
+    def __iter__(self):
+        stack = [[b'{', None, [], False]]  # bracket, position, content parts, has inner brackets
+        space = False  # whether the content so far ends with a whitespace
+        for match in self.TOKEN.finditer(self.content):
+            kind = match.lastgroup
+            if kind in ('comment', 'directive'):
+                continue
+            if kind == 'text':
+                text = match.group()
+                words = b' '.join(text.split())  # simplify whitespaces
+                if text[:1].isspace() and not space:
+                    words = b' ' + words
+                if words and text[-1:].isspace() and text.strip():
+                    words += b' '
+                if words:
+                    stack[-1][2].append(words)
+                space = text[-1:].isspace()
+                continue
+            space = False
+
+            if kind == 'open':
+                bracket = match.group()
+                position = None
+                if bracket == b'[':
+                    position = self.original_position(match.start())
+                    if self.original_content.startswith(b"'", position + 1):  # not annotated by preprocess
+                        raise InvalidFinalContent(self.content)
+                stack.append([bracket, position, [], False])
+            elif kind == 'close':
+                bracket, position, parts, inner = stack.pop()
+                if not stack or self.PAIRS[bracket] != match.group():
+                    raise InvalidFinalContent(self.content)
+                if inner:
+                    yield self.cut(parts)
+                stack[-1][2].append(b'[%d]' % position if bracket == b'[' else bracket + self.PAIRS[bracket])
+                stack[-1][3] = True
+            else:
+                stack[-1][2].append(self.CLEARED[kind])
+
+        if len(stack) != 1:
+            raise InvalidFinalContent(self.content)
+        if stack[0][3]:
+            yield self.cut(stack[0][2])
+
+    def cut(self, parts):
+        content = b''.join(parts)
+        if b'operator' in content:
+            content = OPERATOR_SUBSCRIPT.sub(b'operator', content)  # disarm operator[]
+        return content
+
+    def original_position(self, position):
+        return position + 2 * bisect.bisect_right(self.joins, position)
 
 
 class RE:
@@ -216,9 +567,16 @@ class RE:
         return rf'{gr}*'
 
 
+@functools.lru_cache(maxsize=None)
+def get_lambda_regex():
+    """return the compiled LambdaRegex, built once in every process"""
+    return LambdaRegex().compile()
+
+
 class LambdaRegex(RE):
     def compile(self):
-        return re.compile(str(self))
+        """return the pattern of the lambdas in the bytes of cuts"""
+        return re.compile(str(self).encode())
 
     def __str__(self):
         return self.lambda_expression()
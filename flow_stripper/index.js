@@ -0,0 +1,55 @@
+'use strict';
+
+/*
+ * Runs as a worker: reads requests from stdin, each being a line with the content length in bytes
+ * followed by the content itself, and replies to every request with a line with the length in bytes
+ * of the content without flow types followed by that content, or with "skip" if it could not be parsed.
+ * As with the flow-remove-types command, only files with a @flow pragma are changed.
+ *
+ * flow-remove-types is installed with `npm install` in this directory, or globally with `npm install -g`.
+ */
+const childProcess = require('child_process');
+const path = require('path');
+
+function requireFlowRemoveTypes() {
+  try {
+    return require('flow-remove-types');
+  } catch (e) {
+    if (e.code !== 'MODULE_NOT_FOUND') {
+      throw e;
+    }
+    // global modules are not resolved by require
+    const globalRoot = childProcess.execSync('npm root -g', {encoding: 'utf8'}).trim();
+    return require(path.join(globalRoot, 'flow-remove-types'));
+  }
+}
+
+const flowRemoveTypes = requireFlowRemoveTypes();
+
+let buffer = Buffer.alloc(0);
+
+process.stdin.on('data', chunk => {
+  buffer = Buffer.concat([buffer, chunk]);
+  for (;;) {
+    const newline = buffer.indexOf('\n');
+    if (newline === -1) {
+      return;
+    }
+    const length = parseInt(buffer.toString('utf8', 0, newline), 10);
+    const end = newline + 1 + length;
+    if (buffer.length < end) {
+      return;
+    }
+    const content = buffer.toString('utf8', newline + 1, end);
+    buffer = buffer.subarray(end);
+
+    let reply;
+    try {
+      const stripped = Buffer.from(flowRemoveTypes(content).toString(), 'utf8');
+      reply = Buffer.concat([Buffer.from(`${stripped.length}\n`), stripped]);
+    } catch (e) {
+      reply = Buffer.from('skip\n');
+    }
+    process.stdout.write(reply);
+  }
+});
@@ -1,13 +1,17 @@
+import asyncio
 import csv
 import datetime
+import hashlib
+import json
+import pathlib
+import time
 
-import github
-import gql
-import gql.transport.requests
+import requests
 
 import constants as const
+import store
 
-MAIN_QUERY = gql.gql('''
+MAIN_QUERY = '''
     query ($searchQuery: String!, $first: Int, $after: String) {
       search(type: REPOSITORY, query: $searchQuery, first: $first, after: $after) {
         pageInfo {
@@ -34,25 +38,30 @@ MAIN_QUERY = gql.gql('''
         }
       }
     }
-''')
-
-INIT_COMMIT_QUERY = gql.gql('''
-query ($name: String!, $owner: String!, $cursor: String!) {
-  repository(name: $name, owner: $owner) {
-    defaultBranchRef {
-      target {
-        ... on Commit {
-          history(last: 1, before: $cursor) {
-            nodes {
+'''
+
+INIT_COMMIT_QUERY = '''
+  repository{i}: repository(name: $name{i}, owner: $owner{i}) {{
+    defaultBranchRef {{
+      target {{
+        ... on Commit {{
+          history(last: 1, before: $cursor{i}) {{
+            nodes {{
               committedDate
-            }
-          }
-        }
-      }
-    }
-  }
-}
-''')
+            }}
+          }}
+        }}
+      }}
+    }}
+  }}
+'''
+
+
+def get_init_commits_query(count):
+    """return a query of the first commits of count repositories, aliased repository0, repository1, ..."""
+    variables = ', '.join(f'$name{i}: String!, $owner{i}: String!, $cursor{i}: String!' for i in range(count))
+    fields = ''.join(INIT_COMMIT_QUERY.format(i=i) for i in range(count))
+    return f'query ({variables}) {{{fields}}}'
 
 
 def get_repositories(language, count, data_file):
@@ -63,8 +72,24 @@ def get_repositories(language, count, data_file):
     except FileNotFoundError:
         pass
 
-    client = get_api_client()
-    client_v3 = get_api_client(version=3)
+    repositories = asyncio.run(find_repositories(language, count))
+
+    with store.atomic_open(data_file) as f:
+        header = 'stars,owner,name,min_date,max_date,files\n'
+        f.write(header)
+        writer = csv.writer(f)
+        writer.writerows(repositories)
+
+    return repositories
+
+
+async def find_repositories(language, count):
+    """return [[stars, owner, name, min date, max date, file count]] of the most starred good repositories
+
+    The first commits of the repositories of a search page are queried in batches and their files
+    are counted concurrently, the responses are kept on disk, so that a repeated search is free.
+    """
+    client = ApiClient()
     config = const.CONFIG[language]
     gh_language = config[const.KEYS.GITHUB_NAME]
     skip_repositories = config[const.KEYS.SKIP_REPOSITORIES]
@@ -80,43 +105,42 @@ def get_repositories(language, count, data_file):
         params.update(
             first=min(missing_count, const.GITHUB_API_CONFIG[const.KEYS.QUERY_SIZE_LIMIT]),
         )
-        result = client.execute(MAIN_QUERY, variable_values=params)
+        result = await client.query(MAIN_QUERY, params)
         search_result = result['search']
         nodes = search_result['nodes']
 
         if not nodes:
             raise Exception('not enough repositories in GitHub')
 
-        good_repositories = []
+        candidates = []
         for node in nodes:
             if node['nameWithOwner'] in skip_repositories:
                 continue
 
-            stars = node['stargazers']['totalCount']
-            owner, name = node['nameWithOwner'].split('/')
             commit = node['defaultBranchRef']['target']
-
             max_date = datetime.date.fromisoformat(commit['committedDate'][:10])
             if max_date < const.MAX_COMMIT_DATE:
                 continue
 
-            oid = commit['oid']
-            commit_count = commit['history']['totalCount']
-            result = client.execute(INIT_COMMIT_QUERY, variable_values={
-                'name': name,
-                'owner': owner,
-                'cursor': f'{oid} {commit_count}',
-            })
-            min_date = datetime.date.fromisoformat(
-                result['repository']['defaultBranchRef']['target']['history']['nodes'][0]['committedDate'][:10],
-            )
-            if min_date > config[const.KEYS.START_DATE]:
-                continue
+            candidates.append((node, max_date))
+
+        min_dates = await _get_min_dates(client, [node for node, _ in candidates])
+        candidates = [
+            (node, min_date, max_date)
+            for (node, max_date), min_date in zip(candidates, min_dates)
+            if min_date <= config[const.KEYS.START_DATE]
+        ]
 
-            file_count = client_v3.search_code(f'repo:{owner}/{name} language:{gh_language}').totalCount
+        file_counts = await asyncio.gather(*[
+            client.count_files(node['nameWithOwner'], gh_language) for node, _, _ in candidates
+        ])
+
+        good_repositories = []
+        for (node, min_date, max_date), file_count in zip(candidates, file_counts):
             if file_count < const.MIN_FILES_COUNT:
                 continue
-
+            stars = node['stargazers']['totalCount']
+            owner, name = node['nameWithOwner'].split('/')
             good_repositories.append([stars, owner, name, min_date, max_date, file_count])
 
         repositories.extend(good_repositories)
@@ -126,27 +150,128 @@ def get_repositories(language, count, data_file):
             after=search_result['pageInfo']['endCursor'],
         )
 
-    with open(data_file, 'w') as f:
-        header = 'stars,owner,name,min_date,max_date,files\n'
-        f.write(header)
-        writer = csv.writer(f)
-        writer.writerows(repositories)
-
     return repositories
 
 
-def get_api_client(version=4):
-    with open(const.GITHUB_API_CONFIG[const.KEYS.TOKEN_FILE], 'r') as f:
-        token = f.read().strip()
-    if version == 3:
-        return github.Github(token)
-    sample_transport = gql.transport.requests.RequestsHTTPTransport(
-        url=const.GITHUB_API_CONFIG[const.KEYS.URL],
-        headers={'Authorization': f'Bearer {token}'},
-        retries=const.GITHUB_API_CONFIG[const.KEYS.RETRIES],
-    )
-    client = gql.Client(
-        transport=sample_transport,
-        fetch_schema_from_transport=True,
-    )
-    return client
+async def _get_min_dates(client, nodes):
+    """return the dates of the first commits of the default branches of the repositories"""
+    batch_size = const.GITHUB_API_CONFIG[const.KEYS.BATCH_SIZE]
+    batches = [nodes[i:i + batch_size] for i in range(0, len(nodes), batch_size)]
+    results = await asyncio.gather(*[client.query(get_init_commits_query(len(batch)), {
+        key: value
+        for i, node in enumerate(batch)
+        for key, value in _get_init_commit_params(i, node).items()
+    }) for batch in batches])
+
+    min_dates = []
+    for batch, result in zip(batches, results):
+        for i in range(len(batch)):
+            history = result[f'repository{i}']['defaultBranchRef']['target']['history']
+            min_dates.append(datetime.date.fromisoformat(history['nodes'][0]['committedDate'][:10]))
+    return min_dates
+
+
+def _get_init_commit_params(i, node):
+    owner, name = node['nameWithOwner'].split('/')
+    commit = node['defaultBranchRef']['target']
+    return {
+        f'name{i}': name,
+        f'owner{i}': owner,
+        f'cursor{i}': f'{commit["oid"]} {commit["history"]["totalCount"]}',
+    }
+
+
+class ApiClient:
+    """GitHub GraphQL and REST requests run in threads, at most `concurrency` of them at once
+
+    Responses are kept in GITHUB_CACHE_DIR by request, code searches are spaced to stay
+    within the search rate limit of the API.
+    """
+
+    def __init__(self):
+        config = const.GITHUB_API_CONFIG
+        with open(config[const.KEYS.TOKEN_FILE], 'r') as f:
+            token = f.read().strip()
+        self.headers = {'Authorization': f'Bearer {token}'}
+        self.requests = asyncio.Semaphore(config[const.KEYS.CONCURRENCY])
+        self.searches = RateLimiter(config[const.KEYS.SEARCH_RATE])
+        self.cache_dir = pathlib.Path(f'{const.DATA_DIR}/{const.GITHUB_CACHE_DIR}')
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    async def query(self, query, variables):
+        """return the data of the GraphQL query"""
+        response = await self._request('POST', const.GITHUB_API_CONFIG[const.KEYS.URL], json={
+            'query': query,
+            'variables': variables,
+        })
+        if response.get('errors'):
+            raise Exception(f'GitHub query failed: {response["errors"]}')
+        return response['data']
+
+    async def count_files(self, name_with_owner, gh_language):
+        url = f'{const.GITHUB_API_CONFIG[const.KEYS.REST_URL]}/search/code'
+        params = {'q': f'repo:{name_with_owner} language:{gh_language}', 'per_page': 1}
+        response = await self._request('GET', url, params=params, rate_limiter=self.searches)
+        return response['total_count']
+
+    async def _request(self, method, url, rate_limiter=None, **kwargs):
+        request_id = json.dumps([method, url, kwargs], sort_keys=True)
+        cache_file = self.cache_dir / f'{hashlib.sha1(request_id.encode()).hexdigest()}.json'
+        if cache_file.exists():
+            return json.loads(cache_file.read_text())
+
+        retries = const.GITHUB_API_CONFIG[const.KEYS.RETRIES]
+        for retry in range(retries + 1):
+            if rate_limiter is not None:
+                await rate_limiter.wait()
+            try:
+                async with self.requests:
+                    response = await asyncio.get_running_loop().run_in_executor(
+                        None,
+                        lambda: requests.request(method, url, headers=self.headers, timeout=60, **kwargs),
+                    )
+            except requests.ConnectionError:
+                if retry == retries:
+                    raise
+            else:
+                delay = get_rate_limit_delay(response)
+                if delay is not None and retry < retries:
+                    await asyncio.sleep(delay)
+                    continue
+                if response.status_code < 500 or retry == retries:
+                    break
+            await asyncio.sleep(2 ** retry)
+        response.raise_for_status()
+
+        result = response.json()
+        if not result.get('errors'):
+            cache_file.write_text(response.text)
+        return result
+
+
+def get_rate_limit_delay(response):
+    """return the seconds to wait before retrying a request refused by a rate limit, or None for other responses"""
+    if response.status_code not in (403, 429):
+        return None
+    if 'Retry-After' in response.headers:
+        return max(int(response.headers['Retry-After']), 1)
+    if response.headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in response.headers:
+        return max(int(response.headers['X-RateLimit-Reset']) - time.time(), 1)
+    if response.status_code == 429:
+        return 60  # the API asks to wait at least a minute when it does not say how long
+    return None  # refused for another reason
+
+
+class RateLimiter:
+    """spaces the calls of wait to at most `rate` a minute"""
+
+    def __init__(self, rate):
+        self.interval = 60 / rate
+        self.next_time = 0
+
+    async def wait(self):
+        now = time.monotonic()
+        delay = self.next_time - now
+        self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
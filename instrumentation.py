@@ -0,0 +1,143 @@
+import cProfile
+import collections
+import contextlib
+import functools
+import heapq
+import json
+import multiprocessing.util
+import os
+import threading
+import time
+
+import constants as const
+
+
+class Recorder:
+    """wall and cpu time of stages, event counts and the slowest files of a run of a repository"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}  # {stage: [calls, wall seconds, cpu seconds]}
+        self.counts = collections.Counter()
+        self.slow_files = []  # heap of (seconds, path), the fastest first
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """time the block, its cpu time is the one of the calling thread, without subprocesses"""
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def add_time(self, name, wall_seconds, cpu_seconds):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += 1
+            stage[1] += wall_seconds
+            stage[2] += cpu_seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def add_file(self, path, seconds):
+        """keep the file if it is among the SLOW_FILE_COUNT slowest ones"""
+        with self.lock:
+            heapq.heappush(self.slow_files, (seconds, path))
+            if len(self.slow_files) > const.SLOW_FILE_COUNT:
+                heapq.heappop(self.slow_files)
+
+    def add(self, data):
+        """add the metrics of another recorder, as given by its to_dict"""
+        for name, values in data['stages'].items():
+            with self.lock:
+                stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+                stage[0] += values['calls']
+                stage[1] += values['wall_seconds']
+                stage[2] += values['cpu_seconds']
+        for name, n in data['counts'].items():
+            self.count(name, n)
+        for slow_file in data['slow_files']:
+            self.add_file(slow_file['path'], slow_file['seconds'])
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'stages': {
+                    name: {'calls': calls, 'wall_seconds': wall, 'cpu_seconds': cpu}
+                    for name, (calls, wall, cpu) in sorted(self.stages.items())
+                },
+                'counts': dict(sorted(self.counts.items())),
+                'slow_files': [{'path': path, 'seconds': seconds} for seconds, path in sorted(self.slow_files)[::-1]],
+            }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+_local = threading.local()
+_default_recorder = Recorder()  # of the threads not recording a repository
+
+
+def get_recorder():
+    return getattr(_local, 'recorder', _default_recorder)
+
+
+@contextlib.contextmanager
+def recording(recorder):
+    """record the stages of the calling thread in the recorder"""
+    previous = get_recorder()
+    _local.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _local.recorder = previous
+
+
+def timed(stage):
+    """decorate a function to record its calls as the stage in the recorder of the calling thread"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with get_recorder().stage(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def to_prometheus(metrics):
+    """return the Prometheus text format of the metrics [(labels {name: value}, Recorder.to_dict())]"""
+    samples = collections.defaultdict(list)
+    for labels, data in metrics:
+        for stage, values in data['stages'].items():
+            stage_labels = {**labels, 'stage': stage}
+            samples['lambdas_stage_calls_total'].append((stage_labels, values['calls']))
+            samples['lambdas_stage_wall_seconds_total'].append((stage_labels, values['wall_seconds']))
+            samples['lambdas_stage_cpu_seconds_total'].append((stage_labels, values['cpu_seconds']))
+        for name, value in data['counts'].items():
+            samples['lambdas_events_total'].append(({**labels, 'event': name}, value))
+        for slow_file in data['slow_files']:
+            samples['lambdas_slow_file_seconds'].append(({**labels, 'path': slow_file['path']}, slow_file['seconds']))
+
+    lines = []
+    for name, values in samples.items():
+        lines.append(f'# TYPE {name} {"gauge" if name == "lambdas_slow_file_seconds" else "counter"}')
+        for labels, value in values:
+            label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            lines.append(f'{name}{{{label_text}}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def profile_process(directory):
+    """profile the calling process until it exits, into directory/<pid>.prof in the pstats format"""
+    os.makedirs(directory, exist_ok=True)
+    profiler = cProfile.Profile()
+    # finalizers with a priority run when a process of a multiprocessing pool exits, unlike atexit
+    multiprocessing.util.Finalize(None, profiler.dump_stats, args=(f'{directory}/{os.getpid()}.prof',), exitpriority=0)
+    profiler.enable()
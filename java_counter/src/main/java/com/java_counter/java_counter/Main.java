@@ -1,25 +1,78 @@
 package com.java_counter.java_counter;
 
+import com.github.javaparser.Position;
 import com.github.javaparser.StaticJavaParser;
 import com.github.javaparser.ast.CompilationUnit;
 import com.github.javaparser.ast.expr.LambdaExpr;
 import com.github.javaparser.ast.visitor.VoidVisitorAdapter;
 
+import java.io.BufferedInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
 import java.io.IOException;
+import java.io.InputStream;
+import java.io.PrintStream;
+import java.nio.charset.StandardCharsets;
 import java.nio.file.Paths;
+import java.util.ArrayList;
+import java.util.List;
 
 public class Main {
-    static int count = 0;
-
-    public static void main(String[] args) throws java.io.IOException {
+    /*
+     * Without arguments runs as a worker: reads requests from stdin, each being a line with
+     * the content length in bytes followed by the content itself, and for every request prints
+     * a single line with the lambda count followed by the line:column positions of the lambdas,
+     * or "skip" if the content could not be parsed.
+     */
+    public static void main(String[] args) throws IOException {
         StaticJavaParser.getConfiguration().setAttributeComments(false);
-        CompilationUnit cu = StaticJavaParser.parse(Paths.get(args[0]));
+        if (args.length > 0) {
+            System.out.print(count(StaticJavaParser.parse(Paths.get(args[0]))).size());
+            return;
+        }
+
+        DataInputStream in = new DataInputStream(new BufferedInputStream(System.in));
+        PrintStream out = new PrintStream(System.out, false, "UTF-8");
+        String header;
+        while ((header = readLine(in)) != null) {
+            byte[] content = new byte[Integer.parseInt(header.trim())];
+            in.readFully(content);
+            String result;
+            try {
+                List<Position> positions = count(StaticJavaParser.parse(new String(content, StandardCharsets.UTF_8)));
+                StringBuilder line = new StringBuilder(Integer.toString(positions.size()));
+                for (Position position : positions) {
+                    line.append(' ').append(position.line).append(':').append(position.column);
+                }
+                result = line.toString();
+            } catch (Throwable e) {
+                result = "skip";
+            }
+            out.println(result);
+            out.flush();
+        }
+    }
+
+    static List<Position> count(CompilationUnit cu) {
+        List<Position> positions = new ArrayList<>();
         cu.accept(new VoidVisitorAdapter<Void>() {
             @Override
             public void visit(LambdaExpr n, Void arg) {
-                count += 1;
+                positions.add(n.getBegin().orElse(Position.HOME));
             }
         }, null);
-        System.out.print(count);
+        return positions;
+    }
+
+    static String readLine(InputStream in) throws IOException {
+        ByteArrayOutputStream line = new ByteArrayOutputStream();
+        int b;
+        while ((b = in.read()) != '\n') {
+            if (b == -1) {
+                return line.size() == 0 ? null : line.toString("UTF-8");
+            }
+            line.write(b);
+        }
+        return line.toString("UTF-8");
     }
 }
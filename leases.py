@@ -0,0 +1,101 @@
+import collections
+import pathlib
+import sqlite3
+import threading
+import time
+
+Lease = collections.namedtuple('Lease', ['language', 'owner', 'repository', 'first', 'last'])
+
+LIST_COMMITS = -1  # first and last of the lease listing the commits of a repository and adding their leases
+
+
+class LeaseQueue:
+    """ranges [first, last) of the commits of repositories, leased to the workers sharing the database
+
+    Every repository starts with a lease listing its commits, which adds the leases of its ranges.
+    A lease expires when its worker does not renew it in time, another worker then takes it over
+    and skips the commits done already. The database is on storage shared by the workers, with
+    working file locks, expiry times assume their clocks are in sync.
+    """
+
+    def __init__(self, path):
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS leases (
+                    language TEXT, owner TEXT, repository TEXT, first INTEGER, last INTEGER,
+                    worker TEXT, expires REAL, done INTEGER DEFAULT 0,
+                    PRIMARY KEY (language, owner, repository, first)
+                );
+            ''')
+
+    def add(self, language, owner, repository, first=LIST_COMMITS, last=LIST_COMMITS):
+        """add the lease unless it was added already, done or not"""
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO leases (language, owner, repository, first, last) VALUES (?, ?, ?, ?, ?)',
+                (language, owner, repository, first, last),
+            )
+
+    def acquire(self, worker, duration, preferred=None, excluded=()):
+        """return the Lease given to the worker for duration seconds, or None when all pending ones are taken
+
+        Leases of the preferred repository come first, the ones of the excluded repositories are not given.
+        """
+        now = time.time()
+        excluded = list(excluded)
+        query = 'SELECT language, owner, repository, first, last FROM leases ' \
+                'WHERE done = 0 AND (expires IS NULL OR expires < ?) ' \
+                f'AND repository NOT IN ({", ".join("?" * len(excluded))}) ' \
+                'ORDER BY repository = ? DESC, rowid LIMIT 1'
+        with self.lock, self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')  # other workers wait until the lease is taken
+            row = self.connection.execute(query, (now, *excluded, preferred)).fetchone()
+            if row is None:
+                return None
+            lease = Lease(*row)
+            self.connection.execute(
+                'UPDATE leases SET worker = ?, expires = ? '
+                'WHERE language = ? AND owner = ? AND repository = ? AND first = ?',
+                (worker, now + duration, *lease[:4]),
+            )
+            return lease
+
+    def renew(self, lease, worker, duration):
+        """extend the lease of the worker, return False when it expired and was taken over"""
+        with self.lock:
+            cursor = self.connection.execute(
+                'UPDATE leases SET expires = ? '
+                'WHERE language = ? AND owner = ? AND repository = ? AND first = ? AND worker = ? AND done = 0',
+                (time.time() + duration, *lease[:4], worker),
+            )
+            return cursor.rowcount == 1
+
+    def finish(self, lease):
+        with self.lock:
+            self.connection.execute(
+                'UPDATE leases SET done = 1 WHERE language = ? AND owner = ? AND repository = ? AND first = ?',
+                lease[:4],
+            )
+
+    def get_languages(self):
+        """return the languages of the leases, done or not"""
+        with self.lock:
+            rows = self.connection.execute('SELECT DISTINCT language FROM leases ORDER BY language').fetchall()
+        return [row[0] for row in rows]
+
+    def get_pending_count(self, language=None, owner=None, repository=None):
+        """return the number of leases not done, of all repositories by default"""
+        query = 'SELECT count(*) FROM leases WHERE done = 0 AND ' \
+                'ifnull(?, language) = language AND ifnull(?, owner) = owner AND ifnull(?, repository) = repository'
+        with self.lock:
+            return self.connection.execute(query, (language, owner, repository)).fetchone()[0]
+
+    def is_finished(self, language, owner, repository):
+        """return whether the commits of the repository were listed and all their leases are done"""
+        query = 'SELECT count(*), sum(done = 0) FROM leases WHERE language = ? AND owner = ? AND repository = ?'
+        with self.lock:
+            count, pending = self.connection.execute(query, (language, owner, repository)).fetchone()
+        return count > 0 and not pending
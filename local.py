@@ -1,30 +1,147 @@
-import calendar
+import atexit
 import csv
 import datetime
-import itertools
+import fnmatch
 import os
 import pathlib
 import shutil
 import subprocess
+import threading
 
 import constants as const
+import instrumentation
+import store
 
+FILE_MODES = ('100644', '100755')  # tree entry modes of regular files, symbolic links and submodules are left out
 
-def clone_repository(owner, name):
+
+@instrumentation.timed('clone')
+def clone_repository(owner, name, checkout=True):
     path = f'{const.REPOSITORIES_DIR}/{name}'
     if os.path.exists(path):
         return
     url = f'{const.GITHUB_URL}/{owner}/{name}'
-    cmd = f'git clone {url} {path}'
+    cmd = f'git clone {url} {path}' if checkout else f'git clone --no-checkout {url} {path}'
+    subprocess.run(
+        cmd.split(),
+        capture_output=True,
+        encoding='utf-8',
+        check=True,
+    )
+
+
+@instrumentation.timed('fetch')
+def fetch_repository(owner, name, checkout=True):
+    """clone the repository, or fetch its new commits into an existing clone"""
+    path = f'{const.REPOSITORIES_DIR}/{name}'
+    if not os.path.exists(path):
+        return clone_repository(owner, name, checkout)
+    cmd = 'git fetch origin'
+    subprocess.run(
+        cmd.split(),
+        cwd=path,
+        capture_output=True,
+        encoding='utf-8',
+        check=True,
+    )
+
+
+def get_mirror_path(owner, name):
+    return f'{const.MIRRORS_DIR}/{owner}/{name}.git'
+
+
+@instrumentation.timed('mirror')
+def mirror_repository(language, owner, name, strategy=const.MIRROR_CLONE):
+    """create the bare mirror of the repository, or fetch its new commits into an existing one
+
+    The branches are fetched as remote branches, as in a regular clone, so that origin/HEAD
+    follows the default branch.
+    """
+    path = get_mirror_path(owner, name)
+    if os.path.exists(path):
+        cmd = 'git fetch origin'
+        subprocess.run(
+            cmd.split(),
+            cwd=path,
+            capture_output=True,
+            encoding='utf-8',
+            check=True,
+        )
+        return
+
+    options = {
+        const.MIRROR_CLONE: [],
+        const.BLOBLESS_CLONE: ['--filter=blob:none'],
+        const.SHALLOW_CLONE: [f'--shallow-since={const.CONFIG[language][const.KEYS.START_DATE].isoformat()}'],
+    }[strategy]
+    url = f'{const.GITHUB_URL}/{owner}/{name}'
+    clone_path = f'{path}.clone'  # renamed when complete, an interrupted clone is started again
+    shutil.rmtree(clone_path, ignore_errors=True)
+    subprocess.run(
+        ['git', 'clone', '--bare', *options, url, clone_path],
+        capture_output=True,
+        encoding='utf-8',
+        check=True,
+    )
+    for cmd in ('git config remote.origin.fetch +refs/heads/*:refs/remotes/origin/*', 'git fetch origin'):
+        subprocess.run(
+            cmd.split(),
+            cwd=clone_path,
+            capture_output=True,
+            encoding='utf-8',
+            check=True,
+        )
+    cmd = 'git symbolic-ref --short HEAD'
+    result = subprocess.run(
+        cmd.split(),
+        cwd=clone_path,
+        capture_output=True,
+        encoding='utf-8',
+        check=True,
+    )
+    cmd = f'git symbolic-ref refs/remotes/origin/HEAD refs/remotes/origin/{result.stdout.strip()}'
+    subprocess.run(
+        cmd.split(),
+        cwd=clone_path,
+        capture_output=True,
+        encoding='utf-8',
+        check=True,
+    )
+    os.rename(clone_path, path)
+
+
+@instrumentation.timed('worktree')
+def add_worktree(owner, name, checkout=True):
+    """add a working tree of the mirror at its default branch, sharing the objects and the remote branches"""
+    path = f'{const.REPOSITORIES_DIR}/{name}'
+    if os.path.exists(path):
+        return
+    mirror_path = get_mirror_path(owner, name)
+    cmd = 'git worktree prune'  # forget the working trees removed by delete_repository
     subprocess.run(
         cmd.split(),
+        cwd=mirror_path,
+        capture_output=True,
+        encoding='utf-8',
+        check=True,
+    )
+    options = [] if checkout else ['--no-checkout']
+    subprocess.run(
+        ['git', 'worktree', 'add', '--detach', *options, os.path.abspath(path), 'origin/HEAD'],
+        cwd=mirror_path,
         capture_output=True,
         encoding='utf-8',
         check=True,
     )
 
 
-def get_commits(language, repository_name, data_file):
+@instrumentation.timed('git_log')
+def get_commits(language, repository_name, data_file, sampling=const.MONTHLY_SAMPLING):
+    """return [[date, commit id]] of the first-parent history, oldest first
+
+    The sampling is a period, giving the last commit of every period with its start date,
+    or a number n, giving every n-th commit with its own date.
+    """
     try:
         with open(data_file, 'r') as f:
             f.readline()  # skip header
@@ -32,45 +149,11 @@ def get_commits(language, repository_name, data_file):
     except FileNotFoundError:
         pass
 
-    repository_path = f'{const.REPOSITORIES_DIR}/{repository_name}'
-    config = const.CONFIG[language]
-    from_date = config[const.KEYS.START_DATE]
-    to_date = const.MAX_COMMIT_DATE
-    commits = []
-
-    def get_first_commit_id_between_dates(after, before):
-        """including after, excluding before"""
-        cmd = 'git log --first-parent --format=format:"%h" ' \
-              f'--after={after.isoformat()} --before={before.isoformat()} -1'
-        result = subprocess.run(
-            cmd.split(),
-            cwd=repository_path,
-            capture_output=True,
-            encoding='utf-8',
-            check=True,
-        )
-        return result.stdout.strip('"') or None
+    from_date = const.CONFIG[language][const.KEYS.START_DATE]
+    history = list(reversed(list(_get_first_parent_history(repository_name))))
+    commits = _select_commits(history, from_date, const.MAX_COMMIT_DATE, sampling)
 
-    for year in range(from_date.year, to_date.year + 1):
-        date_from = datetime.date(year, 1, 1)
-        date_to = datetime.date(year, 12, 31)
-        if not get_first_commit_id_between_dates(date_from, date_to + datetime.timedelta(days=1)):
-            continue
-        from_month = 1
-        to_month = 12
-        if year == from_date.year:
-            from_month = from_date.month
-        if year == to_date.year:
-            to_month = to_date.month
-        for month in range(from_month, to_month + 1):
-            to_day = calendar.monthrange(year, month)[1]
-            date_from = datetime.date(year, month, 1)
-            date_to = datetime.date(year, month, to_day)
-            commit_id = get_first_commit_id_between_dates(date_from, date_to + datetime.timedelta(days=1))
-            if commit_id:
-                commits.append([date_from, commit_id])
-
-    with open(data_file, 'w') as f:
+    with store.atomic_open(data_file) as f:
         header = 'date,id\n'
         f.write(header)
         writer = csv.writer(f)
@@ -79,10 +162,80 @@ def get_commits(language, repository_name, data_file):
     return commits
 
 
+@instrumentation.timed('git_log')
+def extend_commits(language, repository_name, data_file, to_date, sampling=const.MONTHLY_SAMPLING):
+    """append the commits following the last one of the data file up to the date, return (commits, new commits)
+
+    The history is read from the remote branch, so that commits fetched into an existing clone are found.
+    """
+    commits = get_commits(language, repository_name, data_file, sampling)
+    history = list(reversed(list(_get_first_parent_history(repository_name, 'origin/HEAD'))))
+    if not commits:
+        from_date = const.CONFIG[language][const.KEYS.START_DATE]
+        new_commits = _select_commits(history, from_date, to_date, sampling)
+    elif isinstance(sampling, int):
+        last_commit = commits[-1][1]
+        # abbreviated ids get longer as a repository grows
+        last = [i for i, (_, commit_id) in enumerate(history) if commit_id.startswith(last_commit)]
+        if not last:
+            raise Exception(f'commit {last_commit} not in history')
+        following = history[last[0] + sampling::sampling]
+        new_commits = [[date, commit_id] for date, commit_id in following if date <= to_date]
+    else:
+        last_period = datetime.date.fromisoformat(str(commits[-1][0]))
+        new_commits = [c for c in _select_commits(history, last_period, to_date, sampling) if c[0] > last_period]
+
+    with open(data_file, 'a') as f:
+        csv.writer(f).writerows(new_commits)
+
+    return commits + new_commits, new_commits
+
+
+def _select_commits(history, from_date, to_date, sampling):
+    """return [[date, commit id]] of the history [(date, commit id)] sorted oldest first"""
+    if isinstance(sampling, int):
+        history = [(date, commit_id) for date, commit_id in history if from_date <= date <= to_date]
+        return [[date, commit_id] for date, commit_id in history[::sampling]]
+
+    get_period_start = PERIOD_STARTS[sampling]
+    from_period = get_period_start(from_date)
+    to_period = get_period_start(to_date)
+    last_commits = {}
+    for date, commit_id in history:
+        period = get_period_start(date)
+        if from_period <= period <= to_period and date <= to_date:
+            last_commits[period] = commit_id
+    return [[period, commit_id] for period, commit_id in sorted(last_commits.items())]
+
+
+def _get_first_parent_history(repository_name, revision='HEAD'):
+    """yield (commit date, commit id) of the first-parent history, newest first"""
+    cmd = f'git log --first-parent --format=format:%h\t%ct {revision}'
+    result = subprocess.run(
+        cmd.split(' '),
+        cwd=f'{const.REPOSITORIES_DIR}/{repository_name}',
+        capture_output=True,
+        encoding='utf-8',
+        check=True,
+    )
+    for line in filter(None, result.stdout.split('\n')):
+        commit_id, timestamp = line.split()
+        yield datetime.date.fromtimestamp(int(timestamp)), commit_id
+
+
+PERIOD_STARTS = {
+    const.WEEKLY_SAMPLING: lambda date: date - datetime.timedelta(days=date.weekday()),
+    const.MONTHLY_SAMPLING: lambda date: date.replace(day=1),
+    const.QUARTERLY_SAMPLING: lambda date: datetime.date(date.year, (date.month - 1) // 3 * 3 + 1, 1),
+}
+
+
+@instrumentation.timed('delete')
 def delete_repository(name):
     shutil.rmtree(f'{const.REPOSITORIES_DIR}/{name}', ignore_errors=True)
 
 
+@instrumentation.timed('checkout')
 def checkout_commit(repository_name, commit):
     cmd = f'git checkout {commit}'
     subprocess.run(
@@ -94,8 +247,117 @@ def checkout_commit(repository_name, commit):
     )
 
 
+def read_file(repository_name, path):
+    with open(f'{const.REPOSITORIES_DIR}/{repository_name}/{path}', 'rb') as f:
+        return f.read()
+
+
+class BlobReader:
+    """long-lived `git cat-file --batch` process streaming blob contents"""
+
+    def __init__(self, repository_name):
+        self.process = subprocess.Popen(
+            'git cat-file --batch'.split(),
+            cwd=f'{const.REPOSITORIES_DIR}/{repository_name}',
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.lock = threading.Lock()
+
+    def read(self, oid):
+        with self.lock:
+            self.process.stdin.write(f'{oid}\n'.encode())
+            self.process.stdin.flush()
+            header = self.process.stdout.readline().decode().split()
+            if len(header) != 3:
+                raise Exception(f'bad object {oid}')
+            content = self.process.stdout.read(int(header[2]))
+            self.process.stdout.read(1)  # skip trailing newline
+            return content
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+
+_blob_readers = {}
+_blob_readers_lock = threading.Lock()
+
+
+def read_blob(repository_name, oid):
+    # readers inherited from a parent process must not be reused, nor readers of a removed clone
+    clone_id = os.stat(f'{const.REPOSITORIES_DIR}/{repository_name}').st_ino
+    key = (os.getpid(), repository_name)
+    with _blob_readers_lock:
+        if key in _blob_readers and _blob_readers[key][0] != clone_id:
+            _blob_readers.pop(key)[1].close()
+        if key not in _blob_readers:
+            reader = BlobReader(repository_name)
+            atexit.register(reader.close)
+            _blob_readers[key] = (clone_id, reader)
+        reader = _blob_readers[key][1]
+    return reader.read(oid)
+
+
+def get_file_size(repository_name, path):
+    return os.path.getsize(f'{const.REPOSITORIES_DIR}/{repository_name}/{path}')
+
+
+@instrumentation.timed('ls_tree')
+def get_blobs(language, repository_name, commit):
+    """return {path: (blob id, size)} of the files of the language in the commit, see is_language_path"""
+    cmd = f'git ls-tree -r -l -z {commit}'
+    result = subprocess.run(
+        cmd.split(),
+        cwd=f'{const.REPOSITORIES_DIR}/{repository_name}',
+        capture_output=True,
+        check=True,
+    )
+    blobs = {}
+    for entry in filter(None, result.stdout.decode('utf-8').split('\0')):
+        info, path = entry.split('\t', 1)
+        mode, _, oid, size = info.split()
+        if mode in FILE_MODES and is_language_path(language, path):
+            blobs[path] = (oid, int(size))
+    return blobs
+
+
+def is_language_path(language, path):
+    """return whether the file at the path has an extension of the language and is selected by its path patterns"""
+    config = const.CONFIG[language]
+    if path.split('.')[-1] not in config[const.KEYS.EXTENSIONS]:
+        return False
+    include_paths = config.get(const.KEYS.INCLUDE_PATHS)
+    if include_paths and not any(fnmatch.fnmatchcase(path, pattern) for pattern in include_paths):
+        return False
+    return not any(fnmatch.fnmatchcase(path, pattern) for pattern in config.get(const.KEYS.EXCLUDE_PATHS, ()))
+
+
+def _get_paths(language, root, commit):
+    """return the sorted paths of the files of the language in the commit, see is_language_path"""
+    cmd = f'git ls-tree -r -z {commit}'
+    result = subprocess.run(
+        cmd.split(),
+        cwd=root,
+        capture_output=True,
+        check=True,
+    )
+    paths = []
+    for entry in filter(None, result.stdout.decode('utf-8').split('\0')):
+        info, path = entry.split('\t', 1)
+        if info.split()[0] in FILE_MODES and is_language_path(language, path):
+            paths.append(path)
+    return sorted(paths)
+
+
 def _get_diff_paths(root, prev_commit, commit):
-    cmd = f'git diff --name-status --no-renames --diff-filter=AMD {prev_commit} {commit}'
+    """yield (status, old blob id, new blob id, path, new path) of the files added, modified, deleted, renamed or copied
+
+    The new path differs from the path only for renamed and copied files. Only regular files are files,
+    a symbolic link becoming a file is added and a file becoming a symbolic link is deleted.
+    """
+    cmd = f'git diff --raw -z --no-abbrev --find-renames --find-copies --diff-filter=AMDRCT {prev_commit} {commit}'
     result = subprocess.run(
         cmd.split(),
         cwd=root,
@@ -103,47 +365,71 @@ def _get_diff_paths(root, prev_commit, commit):
         encoding='utf-8',
         check=True,
     )
-    return map(lambda x: x.split('\t'), filter(None, result.stdout.split('\n')))
+    fields = iter(result.stdout.split('\0'))
+    for info in fields:
+        if not info:
+            continue
+        old_mode, new_mode, old_oid, new_oid, status = info.split()
+        path = next(fields)
+        new_path = next(fields) if status[0] in ('R', 'C') else path
+        old_file = old_mode.lstrip(':') in FILE_MODES
+        new_file = new_mode in FILE_MODES
+        if old_file and new_file:
+            yield status[0], old_oid, new_oid, path, new_path
+            continue
+        if old_file and status[0] != 'C':
+            yield 'D', old_oid, new_oid, path, path
+        if new_file:
+            yield 'A', old_oid, new_oid, new_path, new_path
 
 
-def get_files(language, repository_name, commit, previous_commit, data_file_maker):
-    data_file = data_file_maker(commit)
-    try:
-        with open(data_file, 'r') as f:
-            f.readline()  # skip header
-            return list(csv.reader(f))
-    except FileNotFoundError:
-        pass
+@instrumentation.timed('get_files')
+def get_files(language, repository_name, commit, previous_commit, load_files, save_files, blobs=None):
+    """return [(path, count, line_count, size)], all of them are -1 for the files to count
+
+    The files of a commit are loaded with load_files(commit), giving None when missing, and saved
+    with save_files(commit, files). Blobs of the commit are used instead of the working tree when given.
+    """
+    files = load_files(commit)
+    if files is not None:
+        return files
 
-    extensions = const.CONFIG[language][const.KEYS.EXTENSIONS]
     root = pathlib.Path(f'{const.REPOSITORIES_DIR}/{repository_name}')
 
     if not previous_commit:
-        paths = itertools.chain(*[root.rglob(f'*.{e}') for e in extensions])
-        paths = [str(pathlib.Path(*p.parts[2:])) for p in paths if not p.is_dir()]
-        paths = sorted(paths)
-        files = list(zip(paths, itertools.repeat(-1)))
+        # listed from the commit, not from the working tree with its ignored and untracked files
+        paths = sorted(blobs) if blobs is not None else _get_paths(language, root, commit)
+        files = [(path, -1, -1, -1) for path in paths]
     else:
-        prev_data_file = data_file_maker(previous_commit)
-        with open(prev_data_file, 'r') as f:
-            f.readline()  # skip header
-            files = {path: count for path, count in csv.reader(f)}
+        files = {path: rest for path, *rest in load_files(previous_commit)}
+        # paths are removed before others are added, files may be renamed to the path of another one
+        removed = set()
+        added = {}
         diff_paths = _get_diff_paths(root, previous_commit, commit)
-        for status, path in diff_paths:
-            if path.split('.')[-1] not in extensions:
+        for status, old_oid, new_oid, path, new_path in diff_paths:
+            if status in ('R', 'C'):
+                if status == 'R':
+                    removed.add(path)
+                if not is_language_path(language, new_path):
+                    continue
+                if path in files and old_oid == new_oid:  # the same blob, its results carry over
+                    added[new_path] = files[path]
+                    instrumentation.get_recorder().count('files_moved')
+                else:
+                    added[new_path] = [-1, -1, -1]
+            elif not is_language_path(language, path):
                 continue
             elif status in ('A', 'M'):
-                files[path] = -1
+                added[path] = [-1, -1, -1]
             elif status == 'D':
-                del files[path]
+                removed.add(path)
             else:
                 raise Exception('bad status')
-        files = files.items()
+        for path in removed:
+            files.pop(path, None)
+        files.update(added)
+        files = [(path, *rest) for path, rest in files.items()]
 
-    with open(data_file, 'w') as f:
-        header = 'path,count\n'
-        f.write(header)
-        writer = csv.writer(f)
-        writer.writerows(files)
+    save_files(commit, files)
 
     return files
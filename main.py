@@ -1,21 +1,88 @@
+import collections
+import contextlib
 import csv
+import datetime
 import functools
-import itertools
 import multiprocessing
+import multiprocessing.pool
 import os
+import json
 import pathlib
+import socket
+import threading
+import time
 
 import fire
 
+import analysis
+import benchmark
+import cache
 import constants as const
 import counters
 import github_api
+import instrumentation
+import leases
 import local
+import sampling
+import scheduler
+import store
+
+FileResult = collections.namedtuple(
+    'FileResult',
+    ['count', 'skip_reason', 'sample', 'cache_hit', 'line_count', 'size', 'seconds', 'cpu_seconds'],
+    defaults=[None, -1, -1, None, None],
+)
+# columns of the summary.csv of a repository
+SUMMARY_HEADER = ['date', 'lambdas', 'skipped', 'files', 'timed_out', 'too_large', 'line_count', 'size']
+
+
+def is_counted(_file):
+    """return whether the results of the file are known, they are -1 for the files to count"""
+    return -1 not in map(int, _file[1:4])
 
 
 class Main:
-    def __init__(self, stop_after=None):
+    def __init__(
+            self,
+            stop_after=None,
+            read_mode=const.WORKTREE_READ_MODE,
+            use_cache=True,
+            cpp_engine=None,
+            js_engine=None,
+            sampling=const.MONTHLY_SAMPLING,
+            storage=const.CSV_STORAGE,
+            repository_jobs=None,
+            network_jobs=None,
+            git_jobs=None,
+            cpu_jobs=None,
+            clone_strategy=const.FULL_CLONE,
+            profile_dir=None,
+            queue_path=None,
+    ):
+        if read_mode not in const.READ_MODES:
+            raise Exception('bad read mode')
+        if clone_strategy not in const.CLONE_STRATEGIES:
+            raise Exception('bad clone strategy')
+        if sampling not in const.SAMPLINGS and not (isinstance(sampling, int) and sampling > 0):
+            raise Exception('bad sampling')
+        if cpp_engine is not None and cpp_engine not in const.ENGINES[const.CPP_LANG]:
+            raise Exception('bad cpp engine')
+        if js_engine is not None and js_engine not in const.ENGINES[const.JS_LANG]:
+            raise Exception('bad js engine')
         self.stop_after = stop_after
+        self.read_mode = read_mode
+        self.use_cache = use_cache
+        self.engines = {const.CPP_LANG: cpp_engine, const.JS_LANG: js_engine}
+        self.sampling = sampling
+        self.store = store.get_store(storage)
+        self.scheduler = scheduler.Scheduler(repository_jobs, network_jobs, git_jobs, cpu_jobs)
+        self.clone_strategy = clone_strategy
+        self.profile_dir = profile_dir
+        self.queue_path = queue_path or f'{const.DATA_DIR}/{const.QUEUE_FILE}'
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        self._leased = set()  # repositories cloned by the threads of work
+        self._leased_lock = threading.Lock()
 
     def handle(self, selector=None):
         parts = selector.split('/') if selector else []
@@ -27,7 +94,7 @@ class Main:
         elif count == 4:
             return self.handle_commit(*parts[:4])
         elif count > 4:
-            return self.handle_file(parts[0], parts[2], ('/'.join(parts[4:]), -1))
+            return self.handle_file(parts[0], parts[2], ('/'.join(parts[4:]), -1, -1, -1))
         else:
             raise Exception('invalid selector')
 
@@ -36,258 +103,762 @@ class Main:
             self.handle_language(language)
 
     def handle_language(self, language):
-        done_file = get_data_file(language, filename='done')
+        done_file = store.get_data_file(language, filename='done')
         if os.path.exists(done_file):
             return
 
-        repositories = github_api.get_repositories(language, const.REPOSITORY_COUNT, get_data_file(language))
-        if self.stop_after == 'get_repositories':
-            return repositories
+        with self._recording(language):
+            repositories = github_api.get_repositories(language, const.REPOSITORY_COUNT, store.get_data_file(language))
+            if self.stop_after == 'get_repositories':
+                return repositories
 
-        for repository in repositories:
-            self.handle_repository(language, *repository[1:3])
+            # forking the pool while other threads spawn git would leak their pipes into the counting processes
+            self._get_pool(language)
+            self.scheduler.map(lambda repository: self.handle_repository(language, *repository[1:3]), repositories)
+            self._close_pools()
 
         pathlib.Path(done_file).touch()
 
     def handle_repository(self, language, owner, name):
-        done_file = get_data_file(language, owner, name, filename='done')
+        done_file = store.get_data_file(language, owner, name, filename='done')
         if os.path.exists(done_file):
             return
 
-        local.clone_repository(owner, name)
-        if self.stop_after == 'git_clone':
-            return
+        with self._recording(language, owner, name):
+            self._clone_repository(language, owner, name)
+            if self.stop_after == 'git_clone':
+                return
 
-        commits = local.get_commits(language, name, get_data_file(language, owner, name))
-        if self.stop_after == 'get_commits':
-            return commits
+            with self.scheduler.git:
+                commits = local.get_commits(language, name, store.get_data_file(language, owner, name), self.sampling)
+            if self.stop_after == 'get_commits':
+                return commits
 
-        previous_commit = None
-        for date, commit_id in commits:
-            self.handle_commit(language, owner, name, commit_id, previous_commit, date)
-            previous_commit = commit_id
+            self._handle_commit_list(language, owner, name, commits)
 
-        local.delete_repository(name)
+            local.delete_repository(name)
 
-        self.make_repo_summary(f'{language}/{owner}/{name}')
+            with instrumentation.get_recorder().stage('summary'):
+                self.make_repo_summary(f'{language}/{owner}/{name}')
 
         pathlib.Path(done_file).touch()
 
-    def handle_commit(self, language, repository_owner, repository_name, commit, previous_commit=None, date=None):
-        done_file = get_data_file(language, repository_owner, repository_name, commit, filename='done')
-        if os.path.exists(done_file):
-            return
+    def update(self, to_date=None):
+        for language in const.LANGUAGES:
+            self.update_language(language, to_date)
+
+    def update_language(self, language, to_date=None):
+        """extend the finished repositories of the language with the commits up to the date
+
+        The date is by default the end of the last complete period, or today when every n-th commit is sampled.
+        """
+        with self._recording(language):
+            repositories = github_api.get_repositories(language, const.REPOSITORY_COUNT, store.get_data_file(language))
+            self._get_pool(language)
+            self.scheduler.map(
+                lambda repository: self.update_repository(language, *repository[1:3], to_date=to_date),
+                repositories,
+            )
+            self._close_pools()
+
+    def update_repository(self, language, owner, name, to_date=None):
+        """count only the commits after the last recorded one, a repository not yet finished is handled as usual"""
+        done_file = store.get_data_file(language, owner, name, filename='done')
+        if not os.path.exists(done_file):
+            return self.handle_repository(language, owner, name)
+        if to_date is None:
+            # the last commit of the current period is not known until it is over
+            to_date = datetime.date.today()
+            if not isinstance(self.sampling, int):
+                to_date = local.PERIOD_STARTS[self.sampling](to_date) - datetime.timedelta(days=1)
+        elif isinstance(to_date, str):
+            to_date = datetime.date.fromisoformat(to_date)
+
+        with self._recording(language, owner, name):
+            self._clone_repository(language, owner, name, fetch=True)
+
+            with self.scheduler.git:
+                commits, new_commits = local.extend_commits(
+                    language,
+                    name,
+                    store.get_data_file(language, owner, name),
+                    to_date,
+                    self.sampling,
+                )
+            if not new_commits:
+                local.delete_repository(name)
+                return
 
-        print(f'handling {language}/{repository_owner}/{repository_name}/{commit} ({date})')
+            # an interrupted update is finished by handle_repository, which rewrites the whole summary
+            os.remove(done_file)
+            self._handle_commit_list(language, owner, name, commits)  # done commits are skipped
 
-        local.checkout_commit(repository_name, commit)
-        if self.stop_after == 'git_checkout':
-            return
+            local.delete_repository(name)
+
+            with instrumentation.get_recorder().stage('summary'):
+                self._write_repo_summary(language, owner, name, new_commits, append=True)
+
+        pathlib.Path(done_file).touch()
+
+    def enqueue(self, *selectors):
+        """add the repositories of the languages or language/owner/name selectors to the queue of work
+
+        Workers on any machine sharing DATA_DIR and the queue then count them, repositories done
+        already are left out. Return the number of repositories added.
+        """
+        queue = leases.LeaseQueue(self.queue_path)
+        count = 0
+        for selector in selectors or const.LANGUAGES:
+            parts = selector.split('/')
+            if len(parts) == 1:
+                language = parts[0]
+                repositories = github_api.get_repositories(language, const.REPOSITORY_COUNT, store.get_data_file(language))
+                names = [repository[1:3] for repository in repositories]
+            elif len(parts) == 3:
+                language, names = parts[0], [parts[1:3]]
+            else:
+                raise Exception('invalid selector')
+            for owner, name in names:
+                if not os.path.exists(store.get_data_file(language, owner, name, filename='done')):
+                    queue.add(language, owner, name)
+                    count += 1
+        return count
+
+    def work(self, worker=None):
+        """count the commits of the leases of the queue until all of them are done, repository_jobs at once
+
+        Each worker id, the host and process by default, must be unique among the workers sharing the queue.
+        """
+        queue = leases.LeaseQueue(self.queue_path)
+        worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+        stop = threading.Event()  # set when a thread fails, the other ones stop after their lease
+        # forking the pool while other threads spawn git would leak their pipes into the counting processes
+        for language in queue.get_languages():
+            self._get_pool(language)
+        try:
+            self.scheduler.map(
+                lambda i: self._work(queue, f'{worker}:{i}', stop),
+                range(self.scheduler.repository_jobs),
+            )
+        finally:
+            self._close_pools()
+
+    def _work(self, queue, worker, stop):
+        """handle leases until none is pending, the clone of a repository is kept for its next leases"""
+        cloned = None  # name of the repository cloned by this thread
+        try:
+            while not stop.is_set():
+                with self._leased_lock:
+                    lease = queue.acquire(worker, const.LEASE_DURATION, cloned, self._leased - {cloned})
+                    if lease is not None:
+                        self._leased.add(lease.repository)
+                if cloned and (lease is None or lease.repository != cloned):
+                    self._release_clone(cloned)
+                    cloned = None
+
+                if lease is None:
+                    if not queue.get_pending_count():
+                        return
+                    stop.wait(const.LEASE_POLL_INTERVAL)  # for the leases of other workers to be added or expire
+                    continue
+                cloned = lease.repository
+                self._handle_lease(queue, worker, lease)
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            if cloned:
+                self._release_clone(cloned)
+
+    def _release_clone(self, name):
+        local.delete_repository(name)
+        with self._leased_lock:
+            self._leased.discard(name)
+
+    def _handle_lease(self, queue, worker, lease):
+        """list the commits of the repository and add the leases of their ranges, or count the commits of the range
+
+        The metrics of every lease are written apart, merge adds them to the metrics.json of the repository.
+        """
+        language, owner, name, first, last = lease
+        metrics_name = 'list' if first == leases.LIST_COMMITS else first
+        with self._recording(language, owner, name, name=metrics_name), self._renewing(queue, worker, lease) as lost:
+            self._clone_repository(language, owner, name)
+            with self.scheduler.git:
+                commits = local.get_commits(language, name, store.get_data_file(language, owner, name), self.sampling)
+
+            if first == leases.LIST_COMMITS:
+                for i in range(0, len(commits), const.LEASE_COMMIT_COUNT):
+                    queue.add(language, owner, name, i, min(i + const.LEASE_COMMIT_COUNT, len(commits)))
+                queue.finish(lease)
+                return
+
+            previous_commit = commits[first - 1][1] if first else None
+            if previous_commit and self.store.get_files(language, owner, name, previous_commit) is None:
+                previous_commit = None  # not listed yet by the worker of the previous range, all files are listed
+            # the lease is checked after every commit, or every batch of the objects read mode
+            step = const.OBJECTS_COMMIT_BATCH_SIZE if self.read_mode == const.OBJECTS_READ_MODE else 1
+            for i in range(first, last, step):
+                if lost.is_set():
+                    return  # expired and taken over, the other worker skips the commits done here
+                batch = commits[i:min(i + step, last)]
+                self._handle_commit_list(language, owner, name, batch, previous_commit, journal_name=first)
+                previous_commit = batch[-1][1]
+            if not lost.is_set():
+                queue.finish(lease)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _renewing(queue, worker, lease):
+        """renew the lease from a thread while the block runs, yield an event set when it was taken over"""
+        lost = threading.Event()
+        done = threading.Event()
+
+        def renew():
+            while not done.wait(const.LEASE_RENEW_INTERVAL):
+                if not queue.renew(lease, worker, const.LEASE_DURATION):
+                    lost.set()
+                    return
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield lost
+        finally:
+            done.set()
+            thread.join()
+
+    @contextlib.contextmanager
+    def _recording(self, *selector, name=None):
+        """record the stages of the calling thread, write them to the metrics.json of the language or repository
+
+        Recordings with a name are written to metrics.<name>.json instead.
+        """
+        recorder = instrumentation.Recorder()
+        try:
+            with instrumentation.recording(recorder), recorder.stage('total'):
+                yield recorder
+        finally:
+            filename = 'metrics.json' if name is None else f'metrics.{name}.json'
+            recorder.write(store.get_data_file(*selector, filename=filename))
+
+    def _clone_repository(self, language, owner, name, fetch=False):
+        """clone the repository unless it is already cloned, or fetch its new commits"""
+        checkout = self.read_mode == const.WORKTREE_READ_MODE
+        with self.scheduler.network:
+            if self.clone_strategy == const.FULL_CLONE:
+                if fetch:
+                    local.fetch_repository(owner, name, checkout)
+                else:
+                    local.clone_repository(owner, name, checkout)
+            else:
+                local.mirror_repository(language, owner, name, self.clone_strategy)
+        if self.clone_strategy != const.FULL_CLONE:
+            with self.scheduler.git:
+                local.add_worktree(owner, name, checkout)
+
+    def _handle_commit_list(self, language, owner, name, commits, previous_commit=None, journal_name=None):
+        """count the commits in order, each one is diffed against the previous one
+
+        The journal name tells apart the journals of workers counting other commits of the repository.
+        """
+        if self.read_mode == const.OBJECTS_READ_MODE:
+            self._handle_commits(language, owner, name, commits, previous_commit, journal_name)
+        else:
+            for date, commit_id in commits:
+                self.handle_commit(language, owner, name, commit_id, previous_commit, date, journal_name)
+                previous_commit = commit_id
 
-        files = local.get_files(
+    def handle_commit(
+            self,
             language,
+            repository_owner,
             repository_name,
             commit,
-            previous_commit,
-            functools.partial(get_data_file, language, repository_owner, repository_name),
-        )
-        if self.stop_after == 'get_files':
-            return files
+            previous_commit=None,
+            date=None,
+            journal_name=None,
+    ):
+        if self.store.is_done(language, repository_owner, repository_name, commit):
+            return
 
-        self._handle_files(language, repository_owner, repository_name, commit, files)
+        print(f'handling {language}/{repository_owner}/{repository_name}/{commit} ({date})')
 
-        pathlib.Path(done_file).touch()
+        if self.read_mode == const.WORKTREE_READ_MODE:
+            with self.scheduler.git:
+                local.checkout_commit(repository_name, commit)
+            if self.stop_after == 'git_checkout':
+                return
 
-    def _handle_files(self, language, repository_owner, repository_name, commit, files):
-        with multiprocessing.Pool() as p:
-            results = p.map(
-                functools.partial(self.handle_file, language, repository_name),
-                files,
-                len(files) // os.cpu_count() + 1,
-            )
+        files = self._get_files(language, repository_owner, repository_name, commit, previous_commit)
+        if self.stop_after == 'get_files':
+            return files
 
-        data_file = get_data_file(language, repository_owner, repository_name, commit)
-        with open(data_file, 'w') as f:
-            header = 'path,count\n'
-            f.write(header)
-            writer = csv.writer(f)
-            writer.writerows([entry[0][0], entry[1][0]] for entry in zip(files, results))
+        self._handle_files(language, repository_owner, repository_name, commit, files, journal_name)
 
-        count, skipped = functools.reduce(
-            lambda a, b: (a[0] + b[0], a[1] + b[1]),
-            results,
+    def _handle_commits(
+            self,
+            language,
+            repository_owner,
+            repository_name,
+            commits,
+            previous_commit=None,
+            journal_name=None,
+    ):
+        """count batches of commits straight from the object store, blobs shared by them are counted once"""
+        for i in range(0, len(commits), const.OBJECTS_COMMIT_BATCH_SIZE):
+            batch = []
+            for date, commit_id in commits[i:i + const.OBJECTS_COMMIT_BATCH_SIZE]:
+                if not self.store.is_done(language, repository_owner, repository_name, commit_id):
+                    print(f'handling {language}/{repository_owner}/{repository_name}/{commit_id} ({date})')
+                    files = self._get_files(language, repository_owner, repository_name, commit_id, previous_commit)
+                    batch.append((commit_id, files))
+                previous_commit = commit_id
+
+            # the blobs counted for every commit and its samples are journaled before it is saved,
+            # the files of a commit interrupted while saved are counted in the store already
+            journal = store.Journal(language, repository_owner, repository_name, journal_name)
+            for j, (commit_id, files) in enumerate(batch):
+                blobs, saved_samples = journal.get(commit_id) or ([f[4] for f in files if not is_counted(f)], None)
+                batch[j] = (commit_id, files, set(blobs), saved_samples)
+            pending = {}
+            for _, files, blobs, _ in batch:
+                for _file in files:
+                    if _file[4] in blobs:
+                        pending.setdefault(_file[4], _file)  # sampled with the path of the first commit having it
+            pending = list(pending.values())
+            reservoir = sampling.Reservoir()
+            blob_results = self._count_files(language, repository_name, pending, reservoir, journal)
+            blob_results = {_file[4]: result for _file, result in zip(pending, blob_results)}
+            blob_samples = collections.defaultdict(list)
+            for i, *sample in sorted(reservoir.items(), key=lambda item: item[0]):
+                blob_samples[pending[i][4]].append(tuple(sample))
+
+            for commit_id, files, blobs, saved_samples in batch:
+                results = []
+                samples = []
+                for _file in files:
+                    if _file[4] not in blobs:
+                        results.append(self.handle_file(language, repository_name, _file))
+                    else:
+                        results.append(blob_results[_file[4]])
+                        samples.extend(blob_samples.pop(_file[4], []))  # sample a blob only once
+                if saved_samples is not None:
+                    samples = [tuple(sample) for sample in saved_samples]
+                journal.append(commit_id, [sorted(blobs), samples])
+                self._save_results(language, repository_owner, repository_name, commit_id, files, results, samples)
+            journal.clear()
+
+    def _get_files(self, language, repository_owner, repository_name, commit, previous_commit):
+        """return [(path, count, line_count, size)], with the blob id appended in the objects read mode"""
+        blobs = None
+        with self.scheduler.git:
+            if self.read_mode == const.OBJECTS_READ_MODE:
+                blobs = local.get_blobs(language, repository_name, commit)
+            files = local.get_files(
+                language,
+                repository_name,
+                commit,
+                previous_commit,
+                functools.partial(self.store.get_files, language, repository_owner, repository_name),
+                functools.partial(self.store.put_files, language, repository_owner, repository_name),
+                blobs,
+            )
+        if blobs is not None:
+            files = [(path, count, line_count, *reversed(blobs[path])) for path, count, line_count, _ in files]
+        return files
+
+    def _handle_files(self, language, repository_owner, repository_name, commit, files, journal_name=None):
+        journal = store.Journal(language, repository_owner, repository_name, journal_name)
+        reservoir = sampling.Reservoir()
+        results = self._count_files(language, repository_name, files, reservoir, journal, commit)
+        samples = [sample for _, *sample in sorted(reservoir.items(), key=lambda item: item[0])]
+        self._save_results(language, repository_owner, repository_name, commit, files, results, samples)
+        journal.clear()
+
+    def _count_files(self, language, repository_name, files, reservoir, journal=None, commit=None):
+        """return results in the order of files, the biggest files are counted first
+
+        The samples of the results are moved to the reservoir as they come, as (number of the file,
+        path, position, code). Counted results are appended to the journal, the ones found in it
+        are not counted again.
+        """
+        handler = functools.partial(
+            self.handle_file,
+            language,
+            repository_name,
+            use_cache=self.use_cache,
+            engine=self.engines.get(language),
         )
+        recorder = instrumentation.get_recorder()
+        results = [None] * len(files)
+        pending = []
+        for i, _file in enumerate(files):
+            journaled = journal and journal.get(self._get_journal_key(commit, _file))
+            if journaled:
+                result = FileResult(*journaled)
+                reservoir.extend((i, *sample) for sample in result.sample)
+                results[i] = result._replace(sample=[])
+                recorder.count('files_journaled')
+            elif is_counted(_file):
+                results[i] = handler(_file)
+            else:
+                size = int(_file[3])
+                if size == -1:
+                    size = local.get_file_size(repository_name, _file[0])
+                pending.append((size, i, _file))
+        pending.sort(key=lambda p: p[0], reverse=True)
+
+        with recorder.stage('count_files'):
+            numbered_results = self._get_pool(language).imap_unordered(
+                functools.partial(self._handle_numbered_file, handler),
+                [(i, _file) for _, i, _file in pending],
+                const.COUNTING_CHUNK_SIZE,
+            )
+            for i, result in numbered_results:
+                if journal:
+                    journal.append(self._get_journal_key(commit, files[i]), result)
+                reservoir.extend((i, *sample) for sample in result.sample)
+                results[i] = result._replace(sample=[])
+                self._record_file(recorder, language, files[i][0], result)
+        return results
 
-        samples = itertools.chain.from_iterable(r[2] for r in results)
-        sample_file = get_data_file(language, repository_owner, repository_name, commit, filename='sample.txt')
-        with open(sample_file, 'w') as f:
-            for path, position, text in samples:
-                f.writelines([
-                    f'<sample path="{path}" position="{position}">\n',
-                    text,
-                    '\n</sample>\n',
-                ])
+    @staticmethod
+    def _get_journal_key(commit, _file):
+        """return the key of the result of the file in the journal, the blob id in the objects read mode"""
+        return _file[4] if len(_file) > 4 else f'{commit}/{_file[0]}'
 
-        count_file = get_data_file(language, repository_owner, repository_name, commit, filename='count.csv')
-        with open(count_file, 'w') as f:
-            csv.writer(f).writerows([
-                ['key', 'value'],
-                ['lambdas', count],
-                ['skipped_files', skipped],
-                ['files', len(files)],
-            ])
+    @staticmethod
+    def _record_file(recorder, language, path, result):
+        if result.cache_hit:
+            recorder.count('files_cached')
+        else:
+            recorder.count('files_parsed')
+            recorder.add_time(f'count_{language}', result.seconds, result.cpu_seconds)
+            recorder.add_file(path, result.seconds)
+        if result.skip_reason:
+            recorder.count(f'files_{result.skip_reason}')
+
+    @staticmethod
+    def _handle_numbered_file(handler, numbered_file):
+        number, _file = numbered_file
+        return number, handler(_file)
+
+    def _get_pool(self, language):
+        """return a pool counting files, kept alive between commits and shared by repositories"""
+        # java files are counted by the persistent JVM workers, threads are enough to keep them busy
+        kind = 'threads' if language == const.JAVA_LANG else 'processes'
+        with self._pools_lock:
+            if kind not in self._pools:
+                with instrumentation.get_recorder().stage('pool_start'):
+                    if kind == 'threads':
+                        self._pools[kind] = multiprocessing.pool.ThreadPool(len(counters.get_java_workers()))
+                    else:
+                        self._pools[kind] = multiprocessing.Pool(
+                            self.scheduler.cpu_jobs,
+                            counters.init_worker,
+                            (self.profile_dir,),
+                        )
+            return self._pools[kind]
+
+    def _close_pools(self):
+        with self._pools_lock:
+            for pool in self._pools.values():
+                pool.close()
+                pool.join()
+            self._pools = {}
+
+    def _save_results(self, language, repository_owner, repository_name, commit, files, results, samples):
+        count = sum(r.count for r in results)
+        skipped = collections.Counter(r.skip_reason for r in results)
+
+        cache_hits = sum(1 for r in results if r.cache_hit)
+        cache_misses = sum(1 for r in results if r.cache_hit is False)
+        if self.use_cache:
+            cache.get_cache().add_stats(language, cache_hits, cache_misses)
+        recorder = instrumentation.get_recorder()
+        recorder.count('files_reused', sum(1 for _file in files if is_counted(_file)))
+
+        with recorder.stage('save_results'):
+            self.store.put_results(
+                language,
+                repository_owner,
+                repository_name,
+                commit,
+                [(_file[0], r.count, r.line_count, r.size) for _file, r in zip(files, results)],
+                {
+                    'lambdas': count,
+                    'skipped_files': skipped[const.SKIPPED],
+                    'timed_out_files': skipped[const.TIMED_OUT],
+                    'too_large_files': skipped[const.TOO_LARGE],
+                    'files': len(files),
+                    'cache_hits': cache_hits,
+                    'cache_misses': cache_misses,
+                    'line_count': sum(r.line_count for r in results),
+                    'size': sum(r.size for r in results),
+                },
+                samples,
+            )
 
     @staticmethod
-    def handle_file(language, repository_name, _file):
-        """return (count, skipped)"""
+    def handle_file(language, repository_name, _file, use_cache=False, engine=None):
+        """return FileResult, _file is (path, count, line_count, size) or (path, count, line_count, size, blob id)"""
         path = _file[0]
-        count = int(_file[1])
-        if count != -1:
-            return count, 0, []
+        if is_counted(_file):
+            return FileResult(int(_file[1]), None, [], None, int(_file[2]), int(_file[3]))
+
+        size = int(_file[3])
+        if size == -1:
+            size = local.get_file_size(repository_name, path)
+        if size > const.MAX_FILE_SIZE:  # neither read nor its lines counted
+            return FileResult(0, const.TOO_LARGE, [], False if use_cache else None, 0, size, 0.0, 0.0)
+
+        content = None
+        if len(_file) > 4:
+            blob = _file[4]
+        else:
+            content = local.read_file(repository_name, path)
+            blob = cache.get_blob_id(content)
+
+        version = counters.VERSIONS[language]
+        cache_language = language
+        if engine and engine != const.ENGINES[language][0]:  # engines may disagree on some files
+            cache_language = f'{language}:{engine}'
+        cached = cache.get_cache().get(cache_language, version, blob) if use_cache else None
+        if cached is not None:
+            count, skipped, sample, line_count = cached
+            skip_reason = const.SKIPPED if skipped else None
+            if line_count is None:  # cached before line counts were recorded
+                if content is None:
+                    content = local.read_blob(repository_name, blob)
+                line_count = counters.count_lines(content)
+                cache.get_cache().put(cache_language, version, blob, count, skipped, sample, line_count)
+            return FileResult(count, skip_reason, [(path, s[0], s[1]) for s in sample], True, line_count, size)
+
+        if content is None:
+            content = local.read_blob(repository_name, blob)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        line_count = 0
         try:
-            count, sample = counters.count_lambdas(language, repository_name, path)
-            if sample:
-                sample = [(path, s[0], s[1]) for s in sample]
-            return count, 0, sample
-        except counters.SkipFile:
-            return 0, 1, []
+            line_count = counters.count_lines(content)
+            count, sample = counters.count_lambdas(language, content, engine)
+            skip_reason = None
+        except MemoryError:
+            count, sample = 0, []
+            skip_reason = const.TOO_LARGE
+        except counters.SkipFile as e:
+            count, sample = 0, []
+            skip_reason = e.reason
+        seconds, cpu_seconds = time.perf_counter() - wall, time.thread_time() - cpu
+
+        if use_cache and skip_reason in (None, const.SKIPPED):  # budgets may change between runs
+            skipped = int(skip_reason is not None)
+            cache.get_cache().put(cache_language, version, blob, count, skipped, sample, line_count)
+        return FileResult(
+            count,
+            skip_reason,
+            [(path, s[0], s[1]) for s in sample],
+            False if use_cache else None,
+            line_count,
+            size,
+            seconds,
+            cpu_seconds,
+        )
 
     @staticmethod
-    def make_repo_summary(selector):
+    def compare_engines(language, path):
+        """count the files under the path with every engine of the language, return the ones they disagree on"""
+        extensions = const.CONFIG[language][const.KEYS.EXTENSIONS]
+        paths = sorted(p for e in extensions for p in pathlib.Path(path).rglob(f'*.{e}') if not p.is_dir())
+        disagreements = {}
+        for p in paths:
+            content = p.read_bytes()
+            counts = {}
+            for engine in const.ENGINES[language]:
+                try:
+                    counts[engine] = counters.count_lambdas(language, content, engine)[0]
+                except counters.SkipFile:
+                    counts[engine] = 'skip'
+            if len(set(counts.values())) > 1:
+                disagreements[str(p)] = counts
+        return {'files': len(paths), 'disagreements': disagreements}
+
+    @staticmethod
+    def benchmark(
+            languages=const.LANGUAGES,
+            files=200,
+            size=8192,
+            depth=3,
+            path=None,
+            commits=24,
+            git_files=200,
+            save=False,
+    ):
+        """time the counters and the git stages, compare them to the saved baseline or save one
+
+        Every engine counts files of about size bytes with lambdas nested depth times, and the files
+        under the path when given. The git stages run over a repository of commits changing git_files.
+        """
+        if isinstance(languages, str):
+            languages = languages.split(',')
+        baseline_file = f'{const.DATA_DIR}/{const.BENCHMARK_FILE}'
+        return benchmark.run(languages, files, size, depth, path, commits, git_files, baseline_file, save)
+
+    @staticmethod
+    def export_metrics(selector=None):
+        """return the metrics of the languages and repositories, or of the selector, in the Prometheus text format"""
+        parts = selector.split('/') if selector else []
+        metrics = []
+        for path in sorted(pathlib.Path(const.DATA_DIR).glob('**/!/metrics.json')):
+            names = path.relative_to(const.DATA_DIR).parts[:-2]
+            if list(names[:len(parts)]) != parts:
+                continue
+            with open(path, 'r') as f:
+                metrics.append((dict(zip(('language', 'owner', 'repository'), names)), json.load(f)))
+        return instrumentation.to_prometheus(metrics)
+
+    @staticmethod
+    def cache_stats():
+        stats = {}
+        for language, (hits, misses) in cache.get_cache().get_stats().items():
+            stats[language] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else None,
+            }
+        return stats
+
+    def make_repo_summary(self, selector):
         parts = selector.split('/')
         if len(parts) != 3:
             raise Exception('bad selector')
         language = parts[0]
         owner = parts[1]
         repository = parts[2]
-        data_file = get_data_file(language, owner, repository)
+        data_file = store.get_data_file(language, owner, repository)
         with open(data_file, 'r') as f:
             f.readline()
-            commits = list(csv.reader(f))
-        summary_file = get_data_file(language, owner, repository, filename='summary.csv')
-        full_sample_file = get_data_file(language, owner, repository, filename='full_sample.txt')
-        with open(summary_file, 'w') as sf:
-            with open(full_sample_file, 'w') as fsf:
-                w = csv.writer(sf)
-                w.writerow(['date', 'lambdas', 'skipped', 'files'])
-                for date, commit in commits:
-                    data_file = get_data_file(language, owner, repository, commit, filename='count.csv')
-                    with open(data_file, 'r') as f:
-                        f.readline()
-                        rows = list(csv.reader(f))
-                    counts = {r[0]: r[1] for r in rows}
-                    w.writerow([date, counts['lambdas'], counts['skipped_files'], counts['files']])
-                    sample_file = get_data_file(language, owner, repository, commit, filename='sample.txt')
-                    with open(sample_file, 'r') as f:
-                        fsf.write(f.read())
-
-    @staticmethod
-    def merge_all_data():
-        summary_file = get_data_file(filename='summary.csv')
-        with open(summary_file, 'w') as sf:
+            self._write_repo_summary(language, owner, repository, csv.reader(f))
+
+    def _write_repo_summary(self, language, owner, repository, commits, append=False):
+        """write the summary rows of the commits, and the sample of all commits of the repository
+
+        Rows are written as the counts of every commit are read, the sample is kept in a reservoir,
+        so that the memory does not grow with the number of commits. Rows are appended only to a summary
+        with the current columns.
+        """
+        summary_file = store.get_data_file(language, owner, repository, filename='summary.csv')
+        if append:
+            try:
+                with open(summary_file, 'r') as f:
+                    header = next(csv.reader(f), None)
+            except FileNotFoundError:
+                header = None
+            if header != SUMMARY_HEADER:
+                # summaries written with other columns are written again with the rows of all commits
+                return self.make_repo_summary(f'{language}/{owner}/{repository}')
+        with open(summary_file, 'a') if append else store.atomic_open(summary_file) as sf:
             w = csv.writer(sf)
-            w.writerow(['language', 'nameWithOwner', 'date', 'file_count', 'skipped_file_count', 'lambda_count'])
-            for language in const.LANGUAGES:
-                repositories = github_api.get_repositories(language, const.REPOSITORY_COUNT, get_data_file(language))
-                for repository in repositories:
-                    owner = repository[1]
-                    name = repository[2]
-                    repository_summary_file = get_data_file(language, owner, name, filename='summary.csv')
-                    with open(repository_summary_file, 'r') as rsf:
-                        reader = csv.DictReader(rsf)
-                        for row in reader:
-                            w.writerow([
-                                language,
-                                f'{owner}/{name}',
-                                row['date'],
-                                row['files'],
-                                row['skipped'],
-                                row['lambdas'],
-                            ])
+            if not append:
+                w.writerow(SUMMARY_HEADER)
+            for date, commit in commits:
+                counts = self.store.get_counts(language, owner, repository, commit)
+                w.writerow([
+                    date,
+                    counts['lambdas'],
+                    counts['skipped_files'],
+                    counts['files'],
+                    counts.get('timed_out_files', 0),
+                    counts.get('too_large_files', 0),
+                    counts.get('line_count', ''),
+                    counts.get('size', ''),
+                ])
 
-    @staticmethod
-    def add_line_counts():
-        for il, language in enumerate(const.LANGUAGES, 1):
-            print(f'language {il}/3')
-            repositories = github_api.get_repositories(language, const.REPOSITORY_COUNT, get_data_file(language))
-            for ir, repository in enumerate(repositories, 1):
-                print(f'repo {ir}/10')
+        reservoir = sampling.Reservoir()
+        with open(store.get_data_file(language, owner, repository), 'r') as f:
+            f.readline()  # skip header
+            for _, commit in csv.reader(f):
+                reservoir.extend(self.store.iter_samples(language, owner, repository, commit))
+        full_sample_file = store.get_data_file(language, owner, repository, filename='full_sample.txt')
+        with store.atomic_open(full_sample_file) as fsf:
+            fsf.write(store.format_samples(reservoir.items()))
+
+    def export_csv(self, selector=None):
+        """write the results of the sqlite store in the csv layout, for all commits or the ones of the selector"""
+        if isinstance(self.store, store.CsvStore):
+            raise Exception('results are stored as csv already')
+        parts = selector.split('/') if selector else []
+        csv_store = store.CsvStore()
+        for key in self.store.get_commits(*parts[:3]):
+            csv_store.put_results(*key, *self.store.get_results(*key))
+
+    def merge(self):
+        """write the summaries of the repositories of the queue whose leases are all done, then summary.csv
+
+        The summaries are the ones of handle_repository, summary.csv is written once all languages are done.
+        Return the repositories not done yet, as language/owner/name.
+        """
+        queue = leases.LeaseQueue(self.queue_path)
+        pending = []
+        for language in queue.get_languages():
+            repositories = github_api.get_repositories(language, const.REPOSITORY_COUNT, store.get_data_file(language))
+            language_pending = []
+            for repository in repositories:
                 owner, name = repository[1:3]
-                local.clone_repository(owner, name)
-                commits = local.get_commits(language, name, get_data_file(language, owner, name))
-                for date, commit_id in commits:
-                    local.checkout_commit(name, commit_id)
-
-                    data_file = get_data_file(language, owner, name, commit_id)
-                    with open(data_file, 'r') as f:
-                        f.readline()
-                        data = list(csv.reader(f))
-
-                    data = [  # with line count
-                        [path, lambda_count,
-                         sum(1 for _ in open(f'{const.REPOSITORIES_DIR}/{name}/{path}', errors='ignore'))]
-                        for path, lambda_count in data
-                    ]
-                    with open(data_file, 'w') as f:
-                        header = 'path,count,line_count\n'
-                        f.write(header)
-                        writer = csv.writer(f)
-                        writer.writerows(data)
-
-                    line_count = sum(d[2] for d in data)
-                    count_file = get_data_file(language, owner, name, commit_id, filename='count.csv')
-                    with open(count_file, 'a') as f:
-                        csv.writer(f).writerow(['line_count', line_count])
+                done_file = store.get_data_file(language, owner, name, filename='done')
+                if os.path.exists(done_file):
+                    continue
+                if queue.is_finished(language, owner, name):
+                    # the metrics of the leases are added up in the metrics.json of the repository
+                    metrics_file = store.get_data_file(language, owner, name, filename='metrics.json')
+                    lease_metrics_files = sorted(pathlib.Path(metrics_file).parent.glob('metrics.*.json'))
+                    recorder = instrumentation.Recorder()
+                    for path in lease_metrics_files:
+                        with open(path, 'r') as f:
+                            recorder.add(json.load(f))
+                    with instrumentation.recording(recorder), recorder.stage('summary'):
+                        self.make_repo_summary(f'{language}/{owner}/{name}')
+                    recorder.write(metrics_file)
+                    for path in lease_metrics_files:
+                        path.unlink()
+                    pathlib.Path(done_file).touch()
+                else:
+                    language_pending.append(f'{language}/{owner}/{name}')
+            if not language_pending:
+                pathlib.Path(store.get_data_file(language, filename='done')).touch()
+            pending.extend(language_pending)
+
+        if all(os.path.exists(store.get_data_file(language, filename='done')) for language in const.LANGUAGES):
+            self.merge_all_data()
+        return pending
 
-                local.delete_repository(name)
-                repo_summary_file = get_data_file(language, owner, name, filename='summary.csv')
-                with open(repo_summary_file, 'r') as sf:
-                    sf.readline()
-                    data = list(csv.reader(sf))
-                with open(repo_summary_file, 'w') as sf:
-                    w = csv.writer(sf)
-                    w.writerow(['date', 'lambdas', 'skipped', 'files', 'line_count'])
-                    for date, commit in commits:
-                        data_file = get_data_file(language, owner, name, commit, filename='count.csv')
-                        with open(data_file, 'r') as f:
-                            f.readline()
-                            rows = list(csv.reader(f))
-                        counts = {r[0]: r[1] for r in rows}
-                        w.writerow([
-                            date, counts['lambdas'], counts['skipped_files'], counts['files'], counts['line_count'],
-                        ])
-
-        summary_file = get_data_file(filename='summary.csv')
-        with open(summary_file, 'w') as sf:
+    @staticmethod
+    def merge_all_data():
+        repositories = [
+            (language, *repository[1:3])
+            for language in const.LANGUAGES
+            for repository in github_api.get_repositories(language, const.REPOSITORY_COUNT, store.get_data_file(language))
+        ]
+        summaries = analysis.read_summaries(repositories)
+        summary_file = store.get_data_file(filename='summary.csv')
+        with store.atomic_open(summary_file) as sf:
             w = csv.writer(sf)
-            w.writerow([
-                'language', 'nameWithOwner', 'date', 'file_count', 'skipped_file_count', 'line_count', 'lambda_count',
-            ])
-            for language in const.LANGUAGES:
-                repositories = github_api.get_repositories(language, const.REPOSITORY_COUNT, get_data_file(language))
-                for repository in repositories:
-                    owner = repository[1]
-                    name = repository[2]
-                    repository_summary_file = get_data_file(language, owner, name, filename='summary.csv')
-                    with open(repository_summary_file, 'r') as rsf:
-                        reader = csv.DictReader(rsf)
-                        for row in reader:
-                            w.writerow([
-                                language,
-                                f'{owner}/{name}',
-                                row['date'],
-                                row['files'],
-                                row['skipped'],
-                                row['line_count'],
-                                row['lambdas'],
-                            ])
-
-
-def get_data_file(*args, filename='data.csv'):
-    parts = [const.DATA_DIR, *args, '!', f'{filename}']
-    path = '/'.join(parts)
-    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
-    return path
+            w.writerow(summaries.columns)
+            w.writerows(summaries.itertuples(index=False))
+
+    def analyze(self, query='rates', rate='lambda_line_rate', language=None, count=10, by='lambda_count', date=None):
+        """return a query of the results of all repositories as csv
+
+        The rates query gives the monthly rate of every language, or of every repository of the language.
+        The files query gives the top count files by a column of the last commits up to the date of the repositories.
+        """
+        results = analysis.load(self.store)
+        if query == 'rates':
+            return results.pivot(rate, language).to_csv()
+        elif query == 'files':
+            return results.top_files(count, language, by, date).to_csv(index=False)
+        else:
+            raise Exception('bad query')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,42 @@
+import hashlib
+import heapq
+
+import constants as const
+
+
+def get_priority(position, code):
+    """return the priority of a sampled lambda, the same one for the same code at the same position of any file"""
+    return int.from_bytes(hashlib.sha1(f'{position}\n{code}'.encode()).digest()[:8], 'big')
+
+
+class Reservoir:
+    """the `budget` distinct lambdas (..., position, code) with the lowest priorities among the added ones
+
+    Priorities depend only on the lambdas, so a reservoir filled from other reservoirs holds
+    the same lambdas as a reservoir filled with all of theirs, in constant memory.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = const.SAMPLE_BUDGET if budget is None else budget
+        self.heap = []  # (-priority, number, lambda), the lambda with the highest priority first
+        self.lambdas = set()
+        self.added = 0
+
+    def add(self, item):
+        item = tuple(item)
+        if item in self.lambdas:
+            return
+        heapq.heappush(self.heap, (-get_priority(*item[-2:]), self.added, item))
+        self.lambdas.add(item)
+        self.added += 1
+        if len(self.heap) > self.budget:
+            self.lambdas.discard(heapq.heappop(self.heap)[2])
+
+    def extend(self, items):
+        for item in items:
+            self.add(item)
+        return self
+
+    def items(self):
+        """return the lambdas in the order they were added"""
+        return [item for _, _, item in sorted(self.heap, key=lambda entry: entry[1])]
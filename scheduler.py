@@ -0,0 +1,31 @@
+import concurrent.futures
+import os
+import threading
+
+import constants as const
+
+
+class Scheduler:
+    """limits of the stages of handling repositories concurrently
+
+    Every repository is handled in its own thread, its network and git stages are bounded
+    by semaphores shared by all repositories, while files of all of them are counted by
+    a single pool of `cpu_jobs` processes fed in submission order.
+    """
+
+    def __init__(self, repository_jobs=None, network_jobs=None, git_jobs=None, cpu_jobs=None):
+        self.repository_jobs = repository_jobs or const.REPOSITORY_JOBS
+        self.cpu_jobs = cpu_jobs or const.CPU_JOBS or os.cpu_count()
+        self.network = threading.BoundedSemaphore(network_jobs or const.NETWORK_JOBS)
+        self.git = threading.BoundedSemaphore(git_jobs or const.GIT_JOBS)
+
+    def map(self, function, items):
+        """call the function with every item, at most repository_jobs at once, raise the first error"""
+        with concurrent.futures.ThreadPoolExecutor(self.repository_jobs) as executor:
+            futures = [executor.submit(function, item) for item in items]
+            try:
+                return [future.result() for future in futures]
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
@@ -0,0 +1,300 @@
+import contextlib
+import csv
+import json
+import os
+import pathlib
+import re
+import sqlite3
+import tempfile
+import threading
+
+import constants as const
+
+
+def get_data_file(*args, filename='data.csv'):
+    parts = [const.DATA_DIR, *args, '!', f'{filename}']
+    path = '/'.join(parts)
+    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w'):
+    """open a temporary file next to the path, moved over it once written, so the path is whole or missing
+
+    Every writer has its own temporary file, the last one moved wins.
+    """
+    directory, name = os.path.split(path)
+    with tempfile.NamedTemporaryFile(mode, dir=directory or '.', prefix=f'.{name}.', delete=False) as f:
+        try:
+            os.chmod(f.name, 0o644)  # temporary files are private
+            yield f
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path)
+
+
+class Journal:
+    """results of the files counted for the commits of a repository not saved yet, appended as they come
+
+    A run counting again the commits after an interruption takes the results of the journal,
+    and counts only the files that were not done. A line cut by the interruption is skipped.
+    Workers counting other commits of the repository at once use journals with other names.
+    """
+
+    def __init__(self, language, owner, repository, name=None):
+        filename = const.JOURNAL_FILE
+        if name is not None:
+            stem, extension = os.path.splitext(filename)
+            filename = f'{stem}.{name}{extension}'
+        self.path = get_data_file(language, owner, repository, filename=filename)
+        self.results = {}
+        self.file = None
+        self.cut = False  # whether the last line was cut by an interruption
+        try:
+            with open(self.path, 'r', errors='replace') as f:
+                for line in f:
+                    self.cut = not line.endswith('\n')
+                    try:
+                        key, result = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.results[key] = result
+        except FileNotFoundError:
+            pass
+
+    def get(self, key):
+        """return the result of the key as a list, or None"""
+        return self.results.get(key)
+
+    def append(self, key, result):
+        if self.file is None:
+            self.file = open(self.path, 'a')
+            if self.cut:
+                self.file.write('\n')
+        self.file.write(json.dumps([key, result]) + '\n')
+        self.file.flush()
+
+    def clear(self):
+        """remove the journal, once the results of its commits are saved"""
+        if self.file is None and not self.results:
+            return
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+        self.results = {}
+        self.cut = False
+
+
+class CsvStore:
+    """results of every commit in its own directory: data.csv, count.csv, sample.txt and a done marker
+
+    Files are written whole with atomic_open, the done marker is written last.
+    """
+
+    def is_done(self, language, owner, repository, commit):
+        return os.path.exists(get_data_file(language, owner, repository, commit, filename='done'))
+
+    def get_files(self, language, owner, repository, commit):
+        """return [(path, count, line_count, size)] or None if the files of the commit were not listed yet"""
+        try:
+            with open(get_data_file(language, owner, repository, commit), 'r') as f:
+                f.readline()  # skip header
+                # files listed before line counts and sizes were recorded are counted again
+                return [(row + ['-1', '-1'])[:4] for row in csv.reader(f)]
+        except FileNotFoundError:
+            return None
+
+    def put_files(self, language, owner, repository, commit, files):
+        with atomic_open(get_data_file(language, owner, repository, commit)) as f:
+            header = 'path,count,line_count,size\n'
+            f.write(header)
+            writer = csv.writer(f)
+            writer.writerows(files)
+
+    def put_results(self, language, owner, repository, commit, files, counts, samples):
+        """save the counted files, the counts {key: value} and samples [(path, position, text)], mark it done"""
+        self.put_files(language, owner, repository, commit, files)
+
+        sample_file = get_data_file(language, owner, repository, commit, filename='sample.txt')
+        with atomic_open(sample_file) as f:
+            f.write(format_samples(samples))
+
+        count_file = get_data_file(language, owner, repository, commit, filename='count.csv')
+        with atomic_open(count_file) as f:
+            csv.writer(f).writerows([['key', 'value'], *counts.items()])
+
+        pathlib.Path(get_data_file(language, owner, repository, commit, filename='done')).touch()
+
+    def get_counts(self, language, owner, repository, commit):
+        """return {key: value} as strings"""
+        with open(get_data_file(language, owner, repository, commit, filename='count.csv'), 'r') as f:
+            f.readline()
+            return {r[0]: r[1] for r in csv.reader(f)}
+
+    def iter_samples(self, language, owner, repository, commit):
+        """yield the samples (path, position, text) of the commit, reading sample.txt line by line"""
+        with open(get_data_file(language, owner, repository, commit, filename='sample.txt'), 'r') as f:
+            yield from parse_samples(f)
+
+
+class SqliteStore:
+    """results of every commit in a single database, written in one transaction per commit"""
+
+    def __init__(self, path):
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS files (
+                    language TEXT, owner TEXT, repository TEXT, commit_id TEXT, path TEXT, count INTEGER,
+                    line_count INTEGER, size INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS files_commit ON files (language, owner, repository, commit_id);
+                CREATE TABLE IF NOT EXISTS counts (
+                    language TEXT, owner TEXT, repository TEXT, commit_id TEXT, key TEXT, value,
+                    PRIMARY KEY (language, owner, repository, commit_id, key)
+                );
+                CREATE TABLE IF NOT EXISTS samples (
+                    language TEXT, owner TEXT, repository TEXT, commit_id TEXT, path TEXT, position, text TEXT
+                );
+                CREATE INDEX IF NOT EXISTS samples_commit ON samples (language, owner, repository, commit_id);
+                CREATE TABLE IF NOT EXISTS done (
+                    language TEXT, owner TEXT, repository TEXT, commit_id TEXT,
+                    PRIMARY KEY (language, owner, repository, commit_id)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS listed (
+                    language TEXT, owner TEXT, repository TEXT, commit_id TEXT,
+                    PRIMARY KEY (language, owner, repository, commit_id)
+                ) WITHOUT ROWID;
+            ''')
+
+    def _select(self, query, key):
+        with self.lock:
+            return self.connection.execute(query, key).fetchall()
+
+    def is_done(self, language, owner, repository, commit):
+        key = (language, owner, repository, commit)
+        query = 'SELECT 1 FROM done WHERE language = ? AND owner = ? AND repository = ? AND commit_id = ?'
+        return bool(self._select(query, key))
+
+    def get_files(self, language, owner, repository, commit):
+        """return [(path, count, line_count, size)] or None if the files of the commit were not listed yet"""
+        key = (language, owner, repository, commit)
+        query = 'SELECT path, count, line_count, size FROM files ' \
+                'WHERE language = ? AND owner = ? AND repository = ? AND commit_id = ? ORDER BY rowid'
+        rows = self._select(query, key)
+        if not rows:
+            # commits done before listings were recorded are listed too
+            query = 'SELECT 1 FROM listed WHERE language = ? AND owner = ? AND repository = ? AND commit_id = ? ' \
+                    'UNION ALL SELECT 1 FROM done WHERE language = ? AND owner = ? AND repository = ? AND commit_id = ?'
+            return [] if self._select(query, key * 2) else None
+        return [(row[0], *map(str, row[1:])) for row in rows]
+
+    def put_files(self, language, owner, repository, commit, files):
+        with self.lock, self.connection:
+            self.connection.execute('BEGIN')
+            self._replace_files((language, owner, repository, commit), files)
+
+    def _replace_files(self, key, files):
+        self.connection.execute(
+            'DELETE FROM files WHERE language = ? AND owner = ? AND repository = ? AND commit_id = ?',
+            key,
+        )
+        self.connection.executemany(
+            'INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            ((*key, path, *map(int, rest)) for path, *rest in files),
+        )
+        self.connection.execute('INSERT OR IGNORE INTO listed VALUES (?, ?, ?, ?)', key)
+
+    def put_results(self, language, owner, repository, commit, files, counts, samples):
+        key = (language, owner, repository, commit)
+        with self.lock, self.connection:
+            self.connection.execute('BEGIN')
+            self._replace_files(key, files)
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO counts VALUES (?, ?, ?, ?, ?, ?)',
+                ((*key, k, v) for k, v in counts.items()),
+            )
+            self.connection.execute(
+                'DELETE FROM samples WHERE language = ? AND owner = ? AND repository = ? AND commit_id = ?',
+                key,
+            )
+            self.connection.executemany(
+                'INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((*key, *sample) for sample in samples),
+            )
+            self.connection.execute('INSERT OR IGNORE INTO done VALUES (?, ?, ?, ?)', key)
+
+    def get_counts(self, language, owner, repository, commit):
+        key = (language, owner, repository, commit)
+        query = 'SELECT key, value FROM counts ' \
+                'WHERE language = ? AND owner = ? AND repository = ? AND commit_id = ? ORDER BY rowid'
+        return {k: str(v) for k, v in self._select(query, key)}
+
+    def iter_samples(self, language, owner, repository, commit):
+        key = (language, owner, repository, commit)
+        query = 'SELECT path, position, text FROM samples ' \
+                'WHERE language = ? AND owner = ? AND repository = ? AND commit_id = ? ORDER BY rowid'
+        yield from self._select(query, key)
+
+    def get_results(self, language, owner, repository, commit):
+        """return (files, counts, samples) as given to put_results"""
+        key = (language, owner, repository, commit)
+        return self.get_files(*key), self.get_counts(*key), list(self.iter_samples(*key))
+
+    def get_commits(self, language=None, owner=None, repository=None):
+        """return [(language, owner, repository, commit id)] of the done commits, all of them by default"""
+        query = 'SELECT language, owner, repository, commit_id FROM done WHERE ' \
+                'ifnull(?, language) = language AND ifnull(?, owner) = owner AND ifnull(?, repository) = repository'
+        return self._select(query, (language, owner, repository))
+
+
+def format_samples(samples):
+    return ''.join(
+        f'<sample path="{path}" position="{position}">\n{text}\n</sample>\n'
+        for path, position, text in samples
+    )
+
+
+SAMPLE_START = re.compile(r'<sample path="(.*)" position="(\d+)">\n')
+
+
+def parse_samples(lines):
+    """yield the samples (path, position, text) of the lines of formatted samples"""
+    sample = None
+    text = []
+    for line in lines:
+        start = SAMPLE_START.fullmatch(line)
+        if start and (sample is None or text and text[-1] == '</sample>\n'):
+            if sample is not None:
+                yield (*sample, ''.join(text[:-1])[:-1])
+            sample = (start.group(1), int(start.group(2)))
+            text = []
+        else:
+            text.append(line)
+    if sample is not None:
+        yield (*sample, ''.join(text[:-1])[:-1])
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(storage=const.CSV_STORAGE):
+    with _stores_lock:
+        if storage not in _stores:
+            if storage == const.CSV_STORAGE:
+                _stores[storage] = CsvStore()
+            elif storage == const.SQLITE_STORAGE:
+                _stores[storage] = SqliteStore(f'{const.DATA_DIR}/{const.STORE_FILE}')
+            else:
+                raise Exception('bad storage')
+        return _stores[storage]
@@ -0,0 +1,131 @@
+import unittest
+
+import constants as const
+import counters
+
+# {name: (content, lambda count)}, counts are the ones of the reference engine, quirks included
+CPP_FIXTURES = {
+    'lambda': (b'auto f = [](int x) { return x; };\n', 1),
+    'nested': (b'void g() { auto f = [&](int x) { return [=]() mutable { return x; }; }; }\n', 2),
+    'subscripts': (b'int a[2]; int b = a[1]; auto f = [a]() { return a[0]; };\n', 1),
+    'init capture': (b'int a[3];\nauto f = [a, &b = a[1]]() -> int { return b; };\n', 0),
+    'attribute': (b'[[nodiscard]] int f(); auto g = []() noexcept -> int { return 0; };\n', 0),
+    'line comment': (b'int x; // auto f = [](){};\nauto g = [](){};\n', 1),
+    'long comment': (b'/* auto f = [](){};\n   auto g = [](){}; */ auto h = [](){};\n', 1),
+    # line comments are removed before long comments, even the end of a long comment
+    'line comment in long comment': (b'/* auto f = [](){}; // */ auto g = [](){};\nauto h = [](){};\n', 2),
+    'unclosed long comment': (b'/* auto f = [](){};\n', 1),
+    'quotes in comments': (b"// it's \"\n/* don't \" */ auto f = [](){};\n", 1),
+    'string': (b'const char *s = "[](){}"; auto f = [](){ return "}"; };\n', 1),
+    'escaped quote': (b'const char *s = "\\"[](){}"; auto f = [](){};\n', 1),
+    'chars': (b"char a = '[', b = '{', c = '\\'', d = '}'; auto f = [](){ return ']'; };\n", 1),
+    'directives': (b'#include <vector>\n#define L [](){}\nauto f = [](){};\n  #pragma once\n', 1),
+    'directive continuation': (b'#define L [](){} \\\n  [](){}\nauto f = [](){};\n', 1),
+    'line continuations': (b'auto f = [\\\n](){ return 1; };\nconst char *s = "a\\\nb";\nauto g = [](){};\n', 2),
+    'operator[]': (
+        b'struct S { int operator[](int i) { return i; } int operator [] (long i) const { return 0; } };\n'
+        b'auto f = [](S s) { return s[0]; };\n',
+        1,
+    ),
+    'crlf': (b'auto f = [](int x)\r\n{\r\n  return x;\r\n};\r\n', 1),
+    'latin-1': (b'// caf\xe9\nauto f = [](){ return "\xe9"; };\n', 1),
+    'unbalanced': (b'auto f = [](){ return 1;\n', None),
+}
+
+# {name: (content, arrow function count)}, told apart by the scanner without esprima
+JS_FIXTURES = {
+    'arrow': ('const f = (x) => x + 1;\n', 1),
+    'nested arrows': ('const f = a => b => (c) => a + b + c;\n', 3),
+    'async arrow': ('const f = async (x) => await x;\n', 1),
+    'regex after a condition': ('if (x) /=>/.test(s);\nconst f = () => 1;\n', 1),
+    'regex after return': ('function g() { return /=>[/]/g; }\nconst f = () => 1;\n', 1),
+    'regex after a block': ('function g() {}\n/=>/.test(s);\nconst f = () => 1;\n', 1),
+    'division': ('const a = b / c / d, f = () => a / 2;\n', 1),
+    'division after parentheses': ('const a = (b + c) / 2 / (() => 1)();\n', 1),
+    'division after a subscript': ('const a = x[0] / 2; const f = y => y;\n', 1),
+    'division after an object': ('const a = {}/1; const f = () => 1;\n', 1),
+    'division after a member word': ('const a = x.return / 2 / y; const f = () => a;\n', 1),
+    'strings and comments': ("const s = '=>', t = \"=>\"; // =>\n/* () => 1 */ const f = () => 1;\n", 1),
+    'template': ('const s = `=> ${a => a} ${`${() => 1}`} =>`;\n', 2),
+    'template with braces': ('const s = `${ {a: () => 1}.a() } ${ ((x) => ({y: x}))(1).y }`;\n', 2),
+}
+# content the scanner leaves to esprima
+JS_FALLBACKS = {
+    'jsx': 'const e = <div onClick={() => 1} />;\n',
+    'type parameters': 'const f = <T>(x) => x;\n',
+    'unbalanced': 'const f = (x => x;\n',
+    'unterminated comment': 'const f = () => 1; /* \n',
+    'unterminated template': 'const s = `${() => 1}\n',
+}
+
+
+class CppScannerTest(unittest.TestCase):
+    """the scanner gives the cuts, counts and samples of the regex engine"""
+
+    def test_cuts(self):
+        for name, (content, _) in CPP_FIXTURES.items():
+            with self.subTest(name):
+                content = content.replace(b'\r\n', b'\n')
+                self.assertEqual(get_cuts(counters.CppScanner(content)), get_cuts(
+                    counters.BracketsIterator(counters.preprocess(content))
+                ))
+
+    def test_counts(self):
+        for name, (content, count) in CPP_FIXTURES.items():
+            with self.subTest(name):
+                results = [get_cpp_result(content, engine) for engine in const.ENGINES[const.CPP_LANG]]
+                self.assertEqual(results[0], results[1])
+                self.assertEqual(results[0] and results[0][0], count)
+
+
+class JsScannerTest(unittest.TestCase):
+    """the scanner gives the counts of esprima, its positions are the arrows instead of the functions"""
+
+    def test_counts(self):
+        for name, (content, count) in JS_FIXTURES.items():
+            with self.subTest(name):
+                self.assertEqual(counters.JsScanner(content).count(), count)
+                self.assertEqual(get_js_count(content, const.JS_ESPRIMA_ENGINE), count)
+                self.assertEqual(get_js_count(content, const.JS_SCANNER_ENGINE), count)
+
+    def test_fallbacks(self):
+        for name, content in {**JS_FALLBACKS, 'flow': '// @flow\nconst f = (x: number) => x;\n'}.items():
+            with self.subTest(name):
+                with self.assertRaises(counters.UnclearJsContent):
+                    counters.JsScanner(content).count()
+        for name, content in JS_FALLBACKS.items():  # flow files need the flow stripper
+            with self.subTest(name):
+                self.assertEqual(
+                    get_js_count(content, const.JS_SCANNER_ENGINE),
+                    get_js_count(content, const.JS_ESPRIMA_ENGINE),
+                )
+
+    def test_syntax_unknown_to_esprima(self):
+        content = 'const f = () => a?.b ?? 1;\n'
+        self.assertEqual(get_js_count(content, const.JS_SCANNER_ENGINE), 1)
+        self.assertIsNone(get_js_count(content, const.JS_ESPRIMA_ENGINE))
+
+
+def get_cuts(cuts):
+    try:
+        return list(cuts)
+    except counters.InvalidFinalContent:
+        return None
+
+
+def get_cpp_result(content, engine):
+    try:
+        return counters.count_lambdas_in_cpp(content, engine)
+    except counters.SkipFile:
+        return None
+
+
+def get_js_count(content, engine):
+    try:
+        return counters.count_lambdas_in_js(content.encode(), engine)[0]
+    except counters.SkipFile:
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import queue
+import select
+import subprocess
+
+
+class WorkerError(Exception):
+    pass
+
+
+class WorkerTimeout(WorkerError):
+    pass
+
+
+class WorkerCrashed(WorkerError):
+    pass
+
+
+class WorkerNotStarted(Exception):
+    """the worker exited before its first reply, it would exit again for every request"""
+
+
+class Worker:
+    """long-running subprocess answering length-prefixed requests with a line each, or content prefixed by its length"""
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.process = None
+        self.replied = False  # whether the worker ever replied, it started fine then
+
+    def start(self):
+        self.process = subprocess.Popen(
+            self.cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.process.kill()
+        self.process.wait()
+        self.process = None
+
+    def request(self, content, timeout=None):
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        try:
+            self.process.stdin.write(f'{len(content)}\n'.encode())
+            self.process.stdin.write(content)
+            self.process.stdin.flush()
+            ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+            if not ready:
+                self.stop()
+                raise WorkerTimeout
+            line = self.process.stdout.readline()
+        except (BrokenPipeError, OSError):
+            self._crash()
+        if not line:
+            self._crash()
+        self.replied = True
+        return line.decode('utf-8').strip()
+
+    def _crash(self):
+        self.stop()
+        if not self.replied:
+            raise WorkerNotStarted(' '.join(self.cmd))
+        raise WorkerCrashed
+
+    def request_content(self, content, timeout=None):
+        """return the content replied after a line with its length, or None for any other line"""
+        line = self.request(content, timeout)
+        if not line.isdigit():
+            return None
+        length = int(line)
+        reply = self.process.stdout.read(length)
+        if len(reply) != length:
+            self.stop()
+            raise WorkerCrashed
+        return reply
+
+
+class WorkerPool:
+    """thread-safe pool of workers started lazily and restarted after a crash or a timeout"""
+
+    def __init__(self, cmd, size):
+        self.workers = [Worker(cmd) for _ in range(size)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def __len__(self):
+        return len(self.workers)
+
+    def request(self, content, timeout=None):
+        worker = self.idle.get()
+        try:
+            return worker.request(content, timeout)
+        finally:
+            self.idle.put(worker)
+
+    def request_content(self, content, timeout=None):
+        worker = self.idle.get()
+        try:
+            return worker.request_content(content, timeout)
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()